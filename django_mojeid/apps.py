@@ -0,0 +1,51 @@
+# django-mojeid - mojeID integration for django
+#
+# Copyright (C) 2013 CZ.NIC
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Used only by django >= 1.7, older versions install the fetcher when
+# the models are loaded and build the attribute sets during the first login
+
+from django.apps import AppConfig
+
+
+class MojeIDConfig(AppConfig):
+    name = 'django_mojeid'
+    verbose_name = 'mojeID'
+
+    def ready(self):
+        from django.conf import settings
+        from django_mojeid.fetchers import install_fetcher
+
+        install_fetcher()
+
+        if getattr(settings, 'OPENID_WARMUP', False):
+            from django_mojeid.warmup import warmup
+            warmup()
+        else:
+            # Build and validate the attribute sets during the startup
+            from django_mojeid.mojeid import get_attribute_sets
+            get_attribute_sets()
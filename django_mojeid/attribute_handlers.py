@@ -1,13 +1,72 @@
+import json
+import logging
+import os
+import Queue
+import sys
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
 
+from django_mojeid.exceptions import DjangoOpenIDException
+
 _handlers = {}
 
+# Handler calls postponed by defer_handlers
+_deferred = threading.local()
+
+logger = logging.getLogger('django_mojeid')
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+# What happens when a handler fails or times out
+FAIL = 'fail'  # the login fails
+LOG = 'log'  # the error is logged and the login continues
+DEFER = 'defer'  # the call is queued and run again by openid_run_handlers
+
 
 class HandlerNotFound(Exception):
     pass
 
 
-def register_handler(handler_name):
+class HandlerTimeout(DjangoOpenIDException):
+    pass
+
+
+def register_handler(handler_name, deferred=False, batch=False, after=(), io_bound=False,
+                     timeout=None, on_error=FAIL):
+    """ Register the function as a handler of a CustomHandler
+
+        The calls of a deferred handler are not run during the login, they
+        are stored in a queue processed by the openid_run_handlers command.
+        A batch handler is called with a list of (user, value) pairs.
+
+        The handler runs after the handlers named in `after` which are
+        called during the same login. The I/O bound handlers (e.g. calling
+        a remote service) run concurrently in a pool of threads.
+
+        A handler with a timeout (in seconds) runs in a thread of its own
+        and the login stops waiting for it when the timeout expires. on_error
+        (FAIL, LOG or DEFER) decides what happens when it fails or times out.
+    """
+    if isinstance(after, basestring):
+        after = (after, )
 
     def function_wrapper(f):
 
@@ -17,7 +76,20 @@ def register_handler(handler_name):
         # This import is required to match the correct import
         from django_mojeid.attribute_handlers import _handlers
 
+        # The dependencies are checked before the handler is used by a login
+        dependencies = dict((name, set(handler.after)) for name, handler in _handlers.iteritems())
+        dependencies[handler_name] = set(after)
+        cycle = _find_cycle(dependencies)
+        if cycle:
+            raise ImproperlyConfigured(_('Handlers %s depend on each other.') % ', '.join(cycle))
+
         # Store function into dict under handler name
+        wrapped_function.deferred = deferred
+        wrapped_function.batch = batch
+        wrapped_function.after = tuple(after)
+        wrapped_function.io_bound = io_bound
+        wrapped_function.timeout = timeout
+        wrapped_function.on_error = on_error
         _handlers[handler_name] = wrapped_function
 
         return wrapped_function
@@ -25,8 +97,307 @@ def register_handler(handler_name):
     return function_wrapper
 
 
-def call_handler(handler_name, *args, **kwargs):
+def _find_cycle(dependencies):
+    """ Return the sorted names of the handlers in a cycle or None
+
+        dependencies are {handler_name: set of the handler names it runs after}.
+    """
+    dependencies = dict((name, set(after) & set(dependencies) - set([name]))
+                        for name, after in dependencies.iteritems())
+    # Remove the handlers which don't depend on any remaining one
+    while True:
+        free = [name for name, after in dependencies.iteritems() if not after]
+        if not free:
+            break
+        for name in free:
+            del dependencies[name]
+        for after in dependencies.itervalues():
+            after.difference_update(free)
+    return sorted(dependencies) or None
+
+
+def get_handler(handler_name):
     try:
-        _handlers[handler_name](*args, **kwargs)
+        return _handlers[handler_name]
     except KeyError:
         raise HandlerNotFound(_('Handler with name %s was not found.') % handler_name)
+
+
+def call_handler(handler_name, user, value):
+    call_handlers([(handler_name, user, value)])
+
+
+def call_handlers(calls):
+    """ Call the handlers, calls are (handler_name, user, value) tuples
+
+        The handlers run in the order given by their dependencies.
+    """
+    handlers = [get_handler(handler_name) for handler_name, user, value in calls]
+
+    deferred_calls = getattr(_deferred, 'calls', None)
+    if deferred_calls is not None:
+        deferred_calls.extend(calls)
+        return
+
+    graph = []
+    for handler, (handler_name, user, value) in zip(handlers, calls):
+        if handler.deferred:
+            enqueue_handler(handler_name, user, value)
+        else:
+            graph.append((handler, handler_name, user, value))
+
+    if graph:
+        _run_graph(graph)
+
+
+def get_handler_pool():
+    """ Return the pool of threads for the I/O bound handlers or None if it is disabled """
+    global _pool, _pool_pid
+    size = getattr(settings, 'MOJEID_HANDLER_THREADS', 4)
+    if not size:
+        return None
+
+    # The threads don't survive the fork
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ThreadPool(size)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def _run_call(handler, user, value):
+    """ Run the call, returns its duration and the error info or None """
+    start = time.time()
+    try:
+        if handler.batch:
+            handler([(user, value)])
+        else:
+            handler(user, value)
+        return time.time() - start, None
+    except Exception:
+        # The caller decides about the error according to the handler policy
+        return time.time() - start, sys.exc_info()
+
+
+def _run_in_thread(results, index, handler, user, value, language):
+    """ Run the call in another thread, its result is always put to the results queue
+
+        The handler runs with the language active in the calling thread.
+    """
+    start = time.time()
+    try:
+        if language:
+            translation.activate(language)
+        result = _run_call(handler, user, value)
+    except BaseException:
+        # The login must not wait for the call forever
+        result = time.time() - start, sys.exc_info()
+
+    try:
+        translation.deactivate()
+        # Every thread has its own connections
+        for connection in connections.all():
+            connection.close()
+    except Exception:
+        logger.exception('Cleanup after handler %s failed', handler)
+    finally:
+        results.put((index, ) + result)
+
+
+def _start_thread(results, index, handler, user, value, language):
+    """ Run the call in a new thread, its result is put to the results queue
+
+        A call which hangs holds just its own thread instead of a thread of
+        the pool, and it starts right away, so its timeout starts with it.
+    """
+    thread = threading.Thread(
+        target=_run_in_thread, args=(results, index, handler, user, value, language),
+        name='mojeid-handler-%s' % index)
+    thread.daemon = True
+    thread.start()
+
+
+def _finish_call(handler, handler_name, user, value, duration, exc_info):
+    """ Report the call and apply the error policy of the handler
+
+        Returns the error info when the login has to fail, otherwise None.
+    """
+    from django_mojeid.signals import handler_finished
+
+    if exc_info is None:
+        outcome = 'success'
+    elif issubclass(exc_info[0], HandlerTimeout):
+        outcome = 'timeout'
+    else:
+        outcome = 'error'
+    handler_finished.send(sender=handler, handler_name=handler_name,
+                          duration=duration, outcome=outcome)
+
+    if exc_info is None or handler.on_error == FAIL:
+        return exc_info
+
+    logger.error('Handler %s failed for user %s', handler_name, user.pk, exc_info=exc_info)
+    if handler.on_error == DEFER:
+        enqueue_handler(handler_name, user, value)
+    return None
+
+
+def _run_graph(calls):
+    """ Run the calls, (handler, handler_name, user, value) tuples
+
+        A call starts once all the calls of the handlers it depends on are
+        finished. The calls with a timeout run in threads of their own, the
+        I/O bound calls are passed to the pool and the others run in this
+        thread meanwhile. The first error is raised after the running calls
+        finish, the calls which haven't started are dropped.
+    """
+    pool = get_handler_pool()
+    called = set(handler_name for handler, handler_name, user, value in calls)
+
+    # Number of the unfinished calls of each handler
+    unfinished = defaultdict(int)
+    for handler, handler_name, user, value in calls:
+        unfinished[handler_name] += 1
+
+    depends = [(set(handler.after) & called) - set([handler_name])
+               for handler, handler_name, user, value in calls]
+
+    # Nothing runs when the calls can't be ordered
+    dependencies = defaultdict(set)
+    for (handler, handler_name, user, value), after in zip(calls, depends):
+        dependencies[handler_name] |= after
+    cycle = _find_cycle(dependencies)
+    if cycle:
+        raise ImproperlyConfigured(_('Handlers %s depend on each other.') % ', '.join(cycle))
+
+    pending = range(len(calls))
+    results = Queue.Queue()
+    language = translation.get_language()
+    # {index: deadline} of the calls running in the other threads
+    running = {}
+    error = None
+
+    def finish(index, duration, exc_info):
+        handler, handler_name, user, value = calls[index]
+        unfinished[handler_name] -= 1
+        return _finish_call(handler, handler_name, user, value, duration, exc_info)
+
+    while pending or running:
+        if error is None:
+            ready = [i for i in pending if not any(unfinished[x] for x in depends[i])]
+            inline = []
+            for i in ready:
+                handler, handler_name, user, value = calls[i]
+                if handler.timeout:
+                    pending.remove(i)
+                    running[i] = time.time() + handler.timeout
+                    _start_thread(results, i, handler, user, value, language)
+                elif pool and handler.io_bound:
+                    pending.remove(i)
+                    running[i] = None
+                    pool.apply_async(_run_in_thread,
+                                     (results, i, handler, user, value, language))
+                else:
+                    inline.append(i)
+
+            if inline:
+                pending.remove(inline[0])
+                handler, handler_name, user, value = calls[inline[0]]
+                error = finish(inline[0], *_run_call(handler, user, value))
+                continue
+        elif not running:
+            break
+
+        deadlines = [x for x in running.itervalues() if x is not None]
+        try:
+            index, duration, exc_info = results.get(
+                timeout=max(0, min(deadlines) - time.time()) if deadlines else None)
+        except Queue.Empty:
+            # Stop waiting for the calls after their deadline, they keep running
+            now = time.time()
+            for i, deadline in running.items():
+                if deadline is not None and deadline <= now:
+                    del running[i]
+                    handler_name = calls[i][1]
+                    try:
+                        raise HandlerTimeout(_('Handler %(name)s timed out after %(timeout)s seconds.')
+                                             % {'name': handler_name, 'timeout': calls[i][0].timeout})
+                    except HandlerTimeout:
+                        failure = finish(i, calls[i][0].timeout, sys.exc_info())
+                    error = error or failure
+            continue
+
+        if index not in running:
+            # The call has already timed out
+            logger.warning('Handler %s finished after %.3f seconds', calls[index][1], duration)
+            continue
+
+        del running[index]
+        failure = finish(index, duration, exc_info)
+        error = error or failure
+
+    if error:
+        raise error[0], error[1], error[2]
+
+
+def enqueue_handler(handler_name, user, value):
+    """ Store the call of a deferred handler in the queue """
+    from django_mojeid.models import HandlerCall
+
+    HandlerCall.objects.create(handler=handler_name, user_id=user.pk,
+                               value=json.dumps(value), created=int(time.time()))
+
+
+def run_queued_calls(handler_name, calls):
+    """ Run the queued calls of a handler
+
+        Each call (a batch handler call) runs in its own transaction.
+        Returns the calls which failed, a batch handler fails as a whole.
+    """
+    from django.contrib.auth import get_user_model
+
+    handler = get_handler(handler_name)
+    users = get_user_model().objects.in_bulk(set(call.user_id for call in calls))
+    # The calls of the deleted users are dropped
+    calls = [call for call in calls if call.user_id in users]
+
+    if handler.batch:
+        try:
+            with atomic():
+                handler([(users[call.user_id], json.loads(call.value)) for call in calls])
+        except Exception:
+            logger.exception('Handler %s failed', handler_name)
+            return calls
+        return []
+
+    failed = []
+    for call in calls:
+        try:
+            with atomic():
+                handler(users[call.user_id], json.loads(call.value))
+        except Exception:
+            logger.exception('Handler %s failed for user %s', handler_name, call.user_id)
+            failed.append(call)
+    return failed
+
+
+@contextmanager
+def defer_handlers():
+    """ Postpone the handlers called within the block until the block succeeds
+
+        The postponed calls are dropped when the block raises an exception.
+    """
+    if getattr(_deferred, 'calls', None) is not None:
+        # Already deferred by an outer block
+        yield
+        return
+
+    _deferred.calls = []
+    try:
+        yield
+        calls = _deferred.calls
+    finally:
+        _deferred.calls = None
+
+    call_handlers(calls)
@@ -31,21 +31,43 @@
 
 __metaclass__ = type
 
+import hashlib
+import json
+import logging
+import time
+
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError
 from django.utils.translation import ugettext_lazy as _
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # django < 1.6
+    from django.db.transaction import commit_on_success as atomic
 
 from openid.consumer.consumer import SUCCESS
-from openid.extensions import ax, pape
+from openid.extensions import pape
 
 from django_mojeid.exceptions import (
     IdentityAlreadyClaimed,
     MissingPhysicalMultiFactor,
     DuplicateUserViolation,
+    RequiredAttributeNotReturned,
+)
+from django_mojeid.mojeid import (
+    IMAGE,
+    ResponseValues,
+    get_attribute_set,
+    get_response_values,
 )
-from django_mojeid.mojeid import get_attributes
-from django_mojeid.attribute_handlers import call_handler
+from django_mojeid.attribute_handlers import call_handlers
+
+logger = logging.getLogger('django_mojeid')
+
+# Key of the profile snapshot which holds the names of the stored images
+PROFILE_IMAGE_REFS = 'image_refs'
 
 
 class OpenIDBackend:
@@ -165,17 +187,27 @@ class OpenIDBackend:
         if user is None:
             return None
 
-        if not new_user:
-            self.update_user_from_openid(user.pk, openid_response, attribute_set)
+        # The attributes of an existing user may be synchronized only once per interval
+        sync = new_user or kwargs.get('force_sync', False) or \
+            OpenIDBackend.is_sync_due(user.pk, attribute_set)
+
+        if not new_user and sync:
+            if getattr(settings, 'MOJEID_PROFILE_SNAPSHOTS', False):
+                # The models are updated later from the snapshot
+                OpenIDBackend.store_profile(user.pk, openid_response, attribute_set)
+                if OpenIDBackend.get_sync_interval(attribute_set):
+                    OpenIDBackend.store_sync_state(user.pk, attribute_set)
+            else:
+                self.update_user_from_openid(user.pk, openid_response, attribute_set)
 
         if getattr(settings, 'OPENID_PHYSICAL_MULTIFACTOR_REQUIRED', False):
-            pape_response = pape.Response.fromSuccessResponse(openid_response)
-            if pape_response is None or \
-                    pape.AUTH_MULTI_FACTOR_PHYSICAL not in pape_response.auth_policies:
+            auth_policies = get_response_values(openid_response).auth_policies
+            if pape.AUTH_MULTI_FACTOR_PHYSICAL not in auth_policies:
                 raise MissingPhysicalMultiFactor()
 
         # Run custom Attribute handler
-        OpenIDBackend.run_handlers(openid_response, user, attribute_set)
+        if sync:
+            OpenIDBackend.run_handlers(openid_response, user, attribute_set)
 
         return user
 
@@ -183,38 +215,46 @@ class OpenIDBackend:
     def get_model_changes(openid_response, only_updatable=False,
                           attribute_set='default'):
 
-        attributes = [x for x in get_attributes(attribute_set) if x.type == 'attribute']
+        attribute_set = get_attribute_set(attribute_set)
 
-        fetch_response = ax.FetchResponse.fromSuccessResponse(openid_response)
+        # filter remove non-updatable attributes
+        models = attribute_set.updatable_models if only_updatable else attribute_set.models
 
-        res = {}
+        values = get_response_values(openid_response)
 
-        # filter remove non-updatable attributes
-        if only_updatable:
-            attributes = [x for x in attributes if x.updatable]
+        res = {}
 
-        for attribute in attributes:
-            if not attribute.model in res.keys():
-                res[attribute.model] = {'user_id_field_name': attribute.user_id_field_name}
-            val = attribute.get_value(fetch_response, attribute.required)
+        for model, user_id_field_name, attributes in models:
+            res[model] = {'user_id_field_name': user_id_field_name}
+            for attribute in attributes:
+                val = attribute.get_value(values, attribute.required)
 
-            if val is not None:
-                res[attribute.model][attribute.modelAttribute] = val
+                if val is not None:
+                    res[model][attribute.modelAttribute] = val
 
         return res
 
     @staticmethod
     def run_handlers(openid_response, user, attribute_set='default'):
-        handlers = [x for x in get_attributes(attribute_set) if x.type == 'handler']
+        handlers = get_attribute_set(attribute_set).handlers
 
         if not handlers:
             return
 
-        fetch_response = ax.FetchResponse.fromSuccessResponse(openid_response)
+        values = get_response_values(openid_response)
 
+        calls = []
         for handler in handlers:
-            val = handler.attribute.get_value(fetch_response, handler.required)
-            call_handler(handler.name, user, val)
+            if handler.attribute.kind == IMAGE:
+                # The handlers get the base64 value, the image isn't stored for them
+                value = values.getSingle(handler.attribute.schema, None)
+                if value is None:
+                    # Fails when the image is required
+                    handler.attribute.get_value(values, handler.required)
+            else:
+                value = handler.attribute.get_value(values, handler.required)
+            calls.append((handler.name, user, value))
+        call_handlers(calls)
 
     def create_user_from_openid(self, openid_response, attribute_set='default'):
         changes = OpenIDBackend.get_model_changes(openid_response, attribute_set=attribute_set)
@@ -224,26 +264,60 @@ class OpenIDBackend:
         # Id will be generated no need to set this field
         del changes[user_model]['user_id_field_name']
 
+        # The images are written before the rows which refer to them
+        values = get_response_values(openid_response)
+        for name in values.pending_images.keys():
+            values.save_image(name)
+
         # Create the main user structure
         user = user_model(**changes[user_model])
         try:
             user.validate_unique()
         except ValidationError, e:
             raise DuplicateUserViolation(", ".join(e.messages))
-        user.save()
 
-        # User created remove it from the dict
-        del changes[user_model]
+        # The user is created whole or not at all
+        with atomic():
+            user.save()
 
-        # Create other structures
-        for model, kwargs in changes.iteritems():
-            foreign_key_name = kwargs['user_id_field_name']
-            del kwargs['user_id_field_name']
-            kwargs[foreign_key_name] = user.pk
-            m = model(**kwargs)
-            m.save()
+            # User created remove it from the dict
+            del changes[user_model]
 
-        OpenIDBackend.associate_openid_response(user, openid_response)
+            # Create other structures, the rows are new so they are inserted directly
+            # (each model holds a single row of the user, so there is nothing to batch)
+            for model, kwargs in changes.iteritems():
+                foreign_key_name = kwargs['user_id_field_name']
+                del kwargs['user_id_field_name']
+                kwargs[foreign_key_name] = user.pk
+                m = model(**kwargs)
+                m.save(force_insert=True)
+
+            # The identity was not associated when the authentication started
+            from django_mojeid.models import UserOpenID
+            try:
+                UserOpenID(user_id=user.pk, claimed_id=openid_response.identity_url) \
+                    .save(force_insert=True)
+            except IntegrityError:
+                raise IdentityAlreadyClaimed(
+                    _("The identity %s has already been claimed")
+                    % openid_response.identity_url)
+
+            # The values which will be updated on the next login are stored now
+            fingerprints = None
+            if getattr(settings, 'MOJEID_SKIP_UNCHANGED_ATTRIBUTES', False):
+                updatable = OpenIDBackend.get_model_changes(openid_response, only_updatable=True,
+                                                            attribute_set=attribute_set)
+                fingerprints = {}
+                for model, kwargs in updatable.iteritems():
+                    del kwargs['user_id_field_name']
+                    fingerprints[OpenIDBackend.get_model_label(model)] = \
+                        OpenIDBackend.get_fingerprint(kwargs)
+            if fingerprints is not None or OpenIDBackend.get_sync_interval(attribute_set):
+                OpenIDBackend.store_sync_state(user.pk, attribute_set, fingerprints)
+
+            if getattr(settings, 'MOJEID_PROFILE_SNAPSHOTS', False):
+                OpenIDBackend.store_profile(user.pk, openid_response, attribute_set,
+                                            materialized=True)
 
         return user
 
@@ -252,13 +326,178 @@ class OpenIDBackend:
         changes = OpenIDBackend.get_model_changes(openid_response, only_updatable=True,
                                                   attribute_set=attribute_set)
 
+        # Skip the models which values haven't changed since the last update
+        skip_unchanged = getattr(settings, 'MOJEID_SKIP_UNCHANGED_ATTRIBUTES', False)
+        fingerprints = None
+        if skip_unchanged:
+            stored = OpenIDBackend.get_sync_state(user_id, attribute_set)
+            stored = json.loads(stored.fingerprints) if stored else {}
+            fingerprints = {}
+
+        values = get_response_values(openid_response)
+        image_fields = dict(
+            (model, [x.modelAttribute for x in attributes if x.kind == IMAGE])
+            for model, user_id_field_name, attributes
+            in get_attribute_set(attribute_set).updatable_models)
+
         for model, kwargs in changes.iteritems():
-            foreign_key_name = kwargs['user_id_field_name']
-            del kwargs['user_id_field_name']
+            foreign_key_name = kwargs.pop('user_id_field_name')
+
+            if skip_unchanged:
+                label = OpenIDBackend.get_model_label(model)
+                fingerprints[label] = OpenIDBackend.get_fingerprint(kwargs)
+                if stored.get(label) == fingerprints[label]:
+                    continue
+
+            # The names of the images are given by their content, so an image
+            # which is already referred to is neither decoded nor written again
+            fields = [x for x in image_fields.get(model, ()) if x in kwargs]
+            if fields:
+                current = model.objects.filter(**{foreign_key_name: user_id}) \
+                    .values(*fields)[:1]
+                current = current[0] if current else {}
+                for field in fields:
+                    if current.get(field) == kwargs[field]:
+                        del kwargs[field]
+                    else:
+                        values.save_image(kwargs[field])
+                if not kwargs:
+                    continue
+
             model.objects.filter(**{foreign_key_name: user_id}).update(**kwargs)
 
+        if skip_unchanged and fingerprints == stored:
+            fingerprints = None
+        if fingerprints is not None or OpenIDBackend.get_sync_interval(attribute_set):
+            OpenIDBackend.store_sync_state(user_id, attribute_set, fingerprints)
+
         return changes
 
+    @staticmethod
+    def store_profile(user_id, openid_response, attribute_set='default', materialized=False):
+        """ Store all the attribute values of the response in a single row
+
+            The images are stored in the file storage and only the names
+            of their files are kept in the row.
+        """
+        from django_mojeid.models import MojeIDProfile
+        response_values = get_response_values(openid_response)
+        data = dict(response_values.data)
+        image_refs = {}
+        for attribute in get_attribute_set(attribute_set).model_attributes:
+            if attribute.kind == IMAGE and attribute.schema in data:
+                name = attribute.get_value(response_values, False)
+                response_values.save_image(name)
+                image_refs[attribute.schema] = name
+                del data[attribute.schema]
+        if image_refs:
+            data[PROFILE_IMAGE_REFS] = image_refs
+
+        values = {
+            'values': json.dumps(data),
+            'updated': int(time.time()),
+            'materialized': materialized,
+        }
+        updated = MojeIDProfile.objects.filter(
+            user_id=user_id, attribute_set=attribute_set).update(**values)
+        if not updated:
+            MojeIDProfile.objects.create(user_id=user_id, attribute_set=attribute_set, **values)
+
+    @classmethod
+    def materialize_profile(cls, profile):
+        """ Update the models from the profile snapshot
+
+            Each snapshot is applied in its own savepoint. A snapshot which
+            lacks a required attribute can never be applied, it is logged
+            and marked as materialized. Any other error is logged and the
+            snapshot stays pending. Returns whether the models were updated.
+        """
+        from django_mojeid.models import MojeIDProfile
+        data = json.loads(profile.values)
+        values = ResponseValues(data, image_refs=data.pop(PROFILE_IMAGE_REFS, None))
+        try:
+            with atomic():
+                cls.update_user_from_openid(profile.user_id, values, profile.attribute_set)
+        except RequiredAttributeNotReturned:
+            logger.exception('Profile snapshot of user %s (%s) skipped',
+                             profile.user_id, profile.attribute_set)
+            updated = False
+        except Exception:
+            logger.exception('Profile snapshot of user %s (%s) failed',
+                             profile.user_id, profile.attribute_set)
+            return False
+        else:
+            updated = True
+
+        # A newer snapshot stored in the meantime remains pending
+        MojeIDProfile.objects.filter(pk=profile.pk, updated=profile.updated) \
+            .update(materialized=True)
+        return updated
+
+    @classmethod
+    def materialize_profiles(cls, user_id=None):
+        """ Update the models from all the pending snapshots (of a user)
+
+            Call it before the models of a user are read when
+            MOJEID_PROFILE_SNAPSHOTS is set.
+        """
+        from django_mojeid.models import MojeIDProfile
+        profiles = MojeIDProfile.objects.filter(materialized=False)
+        if user_id is not None:
+            profiles = profiles.filter(user_id=user_id)
+
+        count = 0
+        for profile in profiles.iterator():
+            if cls.materialize_profile(profile):
+                count += 1
+        return count
+
+    @staticmethod
+    def get_model_label(model):
+        return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+    @staticmethod
+    def get_fingerprint(kwargs):
+        """ Fingerprint of the values which are going to be set to a model """
+        return hashlib.sha1(repr(sorted(kwargs.items()))).hexdigest()
+
+    @staticmethod
+    def get_sync_interval(attribute_set):
+        """ Minimal number of seconds between two synchronizations of the attributes """
+        interval = getattr(settings, 'MOJEID_SYNC_INTERVAL', None)
+        if isinstance(interval, dict):
+            interval = interval.get(attribute_set)
+        return interval or 0
+
+    @staticmethod
+    def is_sync_due(user_id, attribute_set):
+        interval = OpenIDBackend.get_sync_interval(attribute_set)
+        if not interval:
+            return True
+        state = OpenIDBackend.get_sync_state(user_id, attribute_set)
+        return state is None or state.synced + interval <= time.time()
+
+    @staticmethod
+    def get_sync_state(user_id, attribute_set):
+        from django_mojeid.models import UserAttributeSync
+        try:
+            return UserAttributeSync.objects.get(user_id=user_id, attribute_set=attribute_set)
+        except UserAttributeSync.DoesNotExist:
+            return None
+
+    @staticmethod
+    def store_sync_state(user_id, attribute_set, fingerprints=None):
+        """ Mark the attributes as synchronized now, the fingerprints are kept unless given """
+        from django_mojeid.models import UserAttributeSync
+        values = {'synced': int(time.time())}
+        if fingerprints is not None:
+            values['fingerprints'] = json.dumps(fingerprints)
+        updated = UserAttributeSync.objects.filter(
+            user_id=user_id, attribute_set=attribute_set).update(**values)
+        if not updated:
+            UserAttributeSync.objects.create(
+                user_id=user_id, attribute_set=attribute_set, **values)
+
     @staticmethod
     def associate_openid_response(user, openid_response):
         """Associate an OpenID request with a user account."""
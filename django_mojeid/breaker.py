@@ -0,0 +1,156 @@
+# django-mojeid - mojeID integration for django
+#
+# Copyright (C) 2013 CZ.NIC
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Circuit breakers guarding the calls to the OpenID providers"""
+
+import threading
+import time
+
+from urlparse import urlsplit
+
+from django.conf import settings
+
+from openid.consumer.discover import DiscoveryFailure, normalizeURL
+from openid.yadis import xri
+
+
+class CircuitBreaker(object):
+    """ Stops calling an endpoint which keeps failing or responding slowly
+
+        The breaker opens after `failure_threshold` consecutive failures
+        (calls slower than `latency_threshold` are counted as failures).
+        While it is open no calls are allowed. After `reset_timeout` seconds
+        a single probe call is let through (half-open state) and its result
+        decides whether the breaker closes or opens again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, latency_threshold=5.0, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+        self._lock = threading.Lock()
+
+    def _retry_due(self):
+        return time.time() - self.opened_at >= self.reset_timeout
+
+    def is_open(self):
+        """ True when calls are currently refused """
+        with self._lock:
+            return self.state == self.OPEN and not self._retry_due()
+
+    def allow(self):
+        """ Decide whether the call may proceed """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if not self._retry_due():
+                    return False
+                self.state = self.HALF_OPEN
+
+            # Only a single probe is allowed in the half-open state,
+            # unless the previous one never reported its result
+            now = time.time()
+            if self.probe_started and now - self.probe_started < self.reset_timeout:
+                return False
+            self.probe_started = now
+            return True
+
+    def record_success(self, elapsed):
+        if elapsed > self.latency_threshold:
+            self.record_failure()
+            return
+
+        with self._lock:
+            self.probe_started = None
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.probe_started = None
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def _get_key(url):
+    parsed = urlsplit(url)
+    return (parsed.scheme, parsed.hostname, parsed.port)
+
+
+def get_breaker(url):
+    """ Return the circuit breaker of the endpoint which serves the url
+
+        Only the fetcher creates the breakers, for the hosts it contacts.
+    """
+    key = _get_key(url)
+
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(
+                failure_threshold=getattr(settings, 'OPENID_BREAKER_FAILURE_THRESHOLD', 5),
+                latency_threshold=getattr(settings, 'OPENID_BREAKER_LATENCY_THRESHOLD', 5.0),
+                reset_timeout=getattr(settings, 'OPENID_BREAKER_RESET_TIMEOUT', 30),
+            )
+    return breaker
+
+
+def find_breaker(identifier):
+    """ Return the breaker of the host where the identifier is discovered or None
+
+        No breaker is created, so the identifiers entered by the users
+        can't fill the memory.
+    """
+    if xri.identifierScheme(identifier) == 'XRI':
+        return None
+
+    # The same normalization as during the discovery
+    if not urlsplit(identifier).scheme:
+        identifier = 'http://' + identifier
+    try:
+        url = normalizeURL(identifier)
+    except DiscoveryFailure:
+        return None
+
+    with _breakers_lock:
+        return _breakers.get(_get_key(url))
@@ -0,0 +1,155 @@
+# django-mojeid - mojeID integration for django
+#
+# Copyright (C) 2013 CZ.NIC
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""OpenID consumer customizations"""
+
+import os
+import Queue
+import threading
+
+from django.conf import settings
+
+from openid.association import SessionNegotiator
+from openid.consumer.consumer import (
+    GenericConsumer,
+    DiffieHellmanSHA1ConsumerSession,
+    DiffieHellmanSHA256ConsumerSession,
+)
+from openid.dh import DiffieHellman
+
+
+class DiffieHellmanPool(object):
+    """ Pool of precomputed Diffie-Hellman key pairs
+
+        The keys are computed in a background thread, so the modular
+        exponentiation is not a part of the association request. Every
+        key pair is used only once.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _run(self, queue):
+        while True:
+            # Blocks while the pool is full
+            queue.put(DiffieHellman.fromDefaults())
+
+    def _ensure_running(self):
+        # The keys must not be shared by forked processes
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(self.size)
+            thread = threading.Thread(target=self._run, args=(self._queue, ))
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def start(self):
+        """ Start computing the keys, otherwise they are computed since the first use """
+        self._ensure_running()
+
+    def take(self):
+        """ Return a key pair, compute it directly when the pool is empty """
+        self._ensure_running()
+        try:
+            return self._queue.get_nowait()
+        except Queue.Empty:
+            return DiffieHellman.fromDefaults()
+
+
+_dh_pool = None
+_dh_pool_lock = threading.Lock()
+
+
+def get_dh_pool():
+    """ Return the pool of Diffie-Hellman key pairs or None if it is disabled """
+    global _dh_pool
+    size = getattr(settings, 'OPENID_DH_POOL_SIZE', 0)
+    if size and _dh_pool is None:
+        with _dh_pool_lock:
+            if _dh_pool is None:
+                _dh_pool = DiffieHellmanPool(size)
+    return _dh_pool
+
+
+class PooledDiffieHellmanMixin(object):
+    """ Take the key pair from the pool instead of computing it """
+
+    def __init__(self, dh=None):
+        pool = get_dh_pool()
+        if dh is None and pool is not None:
+            dh = pool.take()
+        super(PooledDiffieHellmanMixin, self).__init__(dh)
+
+
+class PooledDiffieHellmanSHA1ConsumerSession(PooledDiffieHellmanMixin,
+                                             DiffieHellmanSHA1ConsumerSession):
+    pass
+
+
+class PooledDiffieHellmanSHA256ConsumerSession(PooledDiffieHellmanMixin,
+                                               DiffieHellmanSHA256ConsumerSession):
+    pass
+
+
+class SecureSessionConsumer(GenericConsumer):
+    """ Consumer which allows the no-encryption sessions only over HTTPS
+
+        Diffie-Hellman is redundant when the association is made over TLS,
+        so the no-encryption sessions may be preferred there. For the plain
+        HTTP endpoints the encrypted sessions are always used.
+
+        The Diffie-Hellman sessions take the key pairs from the pool
+        when it is enabled.
+    """
+
+    session_types = dict(GenericConsumer.session_types, **{
+        'DH-SHA1': PooledDiffieHellmanSHA1ConsumerSession,
+        'DH-SHA256': PooledDiffieHellmanSHA256ConsumerSession,
+    })
+
+    def _negotiateAssociation(self, endpoint):
+        if endpoint.server_url.startswith('https://'):
+            return GenericConsumer._negotiateAssociation(self, endpoint)
+
+        negotiator = self.negotiator
+        self.negotiator = SessionNegotiator([
+            (assoc_type, session_type) for assoc_type, session_type in negotiator.allowed_types
+            if session_type != 'no-encryption'
+        ])
+        try:
+            return GenericConsumer._negotiateAssociation(self, endpoint)
+        finally:
+            self.negotiator = negotiator
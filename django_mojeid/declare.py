@@ -0,0 +1,242 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# django-mojeid - mojeID integration for django
+#
+# Copyright (C) 2013 CZ.NIC
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+""" Declaration of the mojeID attributes in the settings
+
+    The module imports neither django nor python-openid so it is cheap
+    to use in *settings.py*::
+
+        from django_mojeid import declare
+
+        MOJEID_ATTRIBUTES = [
+            declare.Email('auth', 'User', 'email', 'pk'),
+            declare.CustomHandler(declare.FullName, 'full_name_handler'),
+            declare.attribute('example_app.attributes.Avatar',
+                              'example_app', 'UserExtraAttributes', 'avatar', 'user_id'),
+        ]
+
+    The declarations are only recorded, they are resolved into the
+    attributes of *django_mojeid.mojeid* when the attribute sets are built.
+"""
+
+# Kinds of the attribute values
+TEXT = 'text'
+BOOLEAN = 'boolean'
+IMAGE = 'image'
+
+
+def ugettext_noop(message):
+    # Marks the string for the translation, it is translated when used
+    return message
+
+
+class Declaration(object):
+    """ Recorded call of an attribute factory or class """
+
+    __slots__ = ('factory', 'args', 'kwargs')
+
+    def __init__(self, factory, args, kwargs):
+        # Name of an attribute from the catalog or a dotted path to a class
+        self.factory = factory
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        args = [repr(x) for x in self.args]
+        args.extend('%s=%r' % x for x in sorted(self.kwargs.items()))
+        return '%s(%s)' % (self.factory, ', '.join(args))
+
+
+class Declarator(object):
+    """ Declares the attributes of a kind, e.g. Email('auth', 'User', 'email', 'pk') """
+
+    __slots__ = ('factory', )
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __call__(self, *args, **kwargs):
+        return Declaration(self.factory, args, kwargs)
+
+    def __repr__(self):
+        return self.factory
+
+
+def attribute(path, *args, **kwargs):
+    """ Declare an attribute of a custom class given by its dotted path """
+    return Declaration(path, args, kwargs)
+
+
+CustomHandler = Declarator('CustomHandler')
+
+
+# All the attributes provided by mojeID
+# (name, code, schema, text, registration field, kind)
+CATALOG = (
+    ('BirthDate', 'birthdate', 'http://axschema.org/birthDate',
+     ugettext_noop(u'Birth Date'), 'birth_date', TEXT),
+    ('FullName', 'fullname', 'http://axschema.org/namePerson',
+     ugettext_noop(u'Full Name'), None, TEXT),
+    ('FirstName', 'firstname', 'http://axschema.org/namePerson/first',
+     ugettext_noop(u'First Name'), 'first_name', TEXT),
+    ('LastName', 'lastname', 'http://axschema.org/namePerson/last',
+     ugettext_noop(u'Last Name'), 'last_name', TEXT),
+    ('NickName', 'nick', 'http://axschema.org/namePerson/friendly',
+     ugettext_noop(u'Nick Name'), 'username', TEXT),
+    ('Company', 'company', 'http://axschema.org/company/name',
+     ugettext_noop(u'Company'), 'organization', TEXT),
+    ('HomeAddress', 'h_address', 'http://axschema.org/contact/postalAddress/home',
+     ugettext_noop(u'Home Address – Street'), 'address__default__street1', TEXT),
+    ('HomeAddress2', 'h_address2', 'http://axschema.org/contact/postalAddressAdditional/home',
+     ugettext_noop(u'Home Address – Street2'), 'address__default__street2', TEXT),
+    ('HomeAddress3', 'h_address3', 'http://specs.nic.cz/attr/addr/main/street3',
+     ugettext_noop(u'Home Address – Street3'), 'address__default__street3', TEXT),
+    ('HomeCity', 'h_city', 'http://axschema.org/contact/city/home',
+     ugettext_noop(u'Home Address – City'), 'address__default__city', TEXT),
+    ('HomeState', 'h_state', 'http://axschema.org/contact/state/home',
+     ugettext_noop(u'Home Address – State'), 'address__default__state', TEXT),
+    ('HomeCountry', 'h_country', 'http://axschema.org/contact/country/home',
+     ugettext_noop(u'Home Address – Country'), 'address__default__country', TEXT),
+    ('HomePostCode', 'h_postcode', 'http://axschema.org/contact/postalCode/home',
+     ugettext_noop(u'Home Address – Country'), 'address__default__postal_code', TEXT),
+    ('BillingAddress', 'b_address', 'http://specs.nic.cz/attr/addr/bill/street',
+     ugettext_noop(u'Billing Address – Street'), 'address__billing__street1', TEXT),
+    ('BillingAddress2', 'b_address2', 'http://specs.nic.cz/attr/addr/bill/street2',
+     ugettext_noop(u'Billing Address – Street2'), 'address__billing__street2', TEXT),
+    ('BillingAddress3', 'b_address3', 'http://specs.nic.cz/attr/addr/bill/street3',
+     ugettext_noop(u'Billing Address – Street3'), 'address__billing__street3', TEXT),
+    ('BillingCity', 'b_city', 'http://specs.nic.cz/attr/addr/bill/city',
+     ugettext_noop(u'Billing Address – City'), 'address__billing__city', TEXT),
+    ('BillingState', 'b_state', 'http://specs.nic.cz/attr/addr/bill/sp',
+     ugettext_noop(u'Billing Address – State'), 'address__billing__state', TEXT),
+    ('BillingCountry', 'b_country', 'http://specs.nic.cz/attr/addr/bill/cc',
+     ugettext_noop(u'Billing Address – Country'), 'address__billing__country', TEXT),
+    ('BillingPostCode', 'b_postcode', 'http://specs.nic.cz/attr/addr/bill/pc',
+     ugettext_noop(u'Billing Address – Postal Code'), 'address__billing__postal_code', TEXT),
+    ('ShippingAddress', 's_address', 'http://specs.nic.cz/attr/addr/ship/street',
+     ugettext_noop(u'Shipping Address – Street'), 'address__shipping__street1', TEXT),
+    ('ShippingAddress2', 's_address2', 'http://specs.nic.cz/attr/addr/ship/street2',
+     ugettext_noop(u'Shipping Address – Street2'), 'address__shipping__street2', TEXT),
+    ('ShippingAddress3', 's_address3', 'http://specs.nic.cz/attr/addr/ship/street3',
+     ugettext_noop(u'Shipping Address – Street3'), 'address__shipping__street3', TEXT),
+    ('ShippingCity', 's_city', 'http://specs.nic.cz/attr/addr/ship/city',
+     ugettext_noop(u'Shipping Address – City'), 'address__shipping__city', TEXT),
+    ('ShippingState', 's_state', 'http://specs.nic.cz/attr/addr/ship/sp',
+     ugettext_noop(u'Shipping Address – State'), 'address__shipping__state', TEXT),
+    ('ShippingCountry', 's_country', 'http://specs.nic.cz/attr/addr/ship/cc',
+     ugettext_noop(u'Shipping Address – Country'), 'address__shipping__country', TEXT),
+    ('ShippingPostCode', 's_postcode', 'http://specs.nic.cz/attr/addr/ship/pc',
+     ugettext_noop(u'Shipping Address – Postal Code'), 'address__shipping__postal_code', TEXT),
+    ('MailingAddress', 'm_address', 'http://specs.nic.cz/attr/addr/mail/street',
+     ugettext_noop(u'Mailing Address – Street'), 'address__mailing__street1', TEXT),
+    ('MailingAddress2', 'm_address2', 'http://specs.nic.cz/attr/addr/mail/street2',
+     ugettext_noop(u'Mailing Address – Street2'), 'address__mailing__street2', TEXT),
+    ('MailingAddress3', 'm_address3', 'http://specs.nic.cz/attr/addr/mail/street3',
+     ugettext_noop(u'Mailing Address – Street3'), 'address__mailing__street3', TEXT),
+    ('MailingCity', 'm_city', 'http://specs.nic.cz/attr/addr/mail/city',
+     ugettext_noop(u'Mailing Address – City'), 'address__mailing__city', TEXT),
+    ('MailingState', 'm_state', 'http://specs.nic.cz/attr/addr/mail/sp',
+     ugettext_noop(u'Mailing Address – State'), 'address__mailing__state', TEXT),
+    ('MailingCountry', 'm_country', 'http://specs.nic.cz/attr/addr/mail/cc',
+     ugettext_noop(u'Mailing Address – Country'), 'address__mailing__country', TEXT),
+    ('MailingPostCode', 'm_postcode', 'http://specs.nic.cz/attr/addr/mail/pc',
+     ugettext_noop(u'Mailing Address – Postal Code'), 'address__mailing__postal_code', TEXT),
+    ('Phone', 'phone', 'http://axschema.org/contact/phone/default',
+     ugettext_noop(u'Phone – Default'), 'phone__default__number', TEXT),
+    ('PhoneHome', 'phone_home', 'http://axschema.org/contact/phone/home',
+     ugettext_noop(u'Phone – Home'), 'phone__home__number', TEXT),
+    ('PhoneWork', 'phone_work', 'http://axschema.org/contact/phone/business',
+     ugettext_noop(u'Phone – Work'), 'phone__office__number', TEXT),
+    ('PhoneMobile', 'phone_mobile', 'http://axschema.org/contact/phone/cell',
+     ugettext_noop(u'Phone – Mobile'), 'phone__mobile__number', TEXT),
+    ('Fax', 'fax', 'http://axschema.org/contact/phone/fax',
+     ugettext_noop(u'Fax'), None, TEXT),
+    ('Email', 'email', 'http://axschema.org/contact/email',
+     ugettext_noop(u'Email – Default'), 'email__default__email', TEXT),
+    ('Email2', 'email2', 'http://specs.nic.cz/attr/email/notify',
+     ugettext_noop(u'Email – Notify'), 'email__notify__email', TEXT),
+    ('Email3', 'email3', 'http://specs.nic.cz/attr/email/next',
+     ugettext_noop(u'Email – Other'), 'email__next__email', TEXT),
+    ('Url', 'url', 'http://axschema.org/contact/web/default',
+     ugettext_noop(u'URL – Default'), 'urladdress__main__url', TEXT),
+    ('Blog', 'blog', 'http://axschema.org/contact/web/blog',
+     ugettext_noop(u'URL – Blog'), 'urladdress__blog__url', TEXT),
+    ('Url2', 'url2', 'http://specs.nic.cz/attr/url/personal',
+     ugettext_noop(u'URL – Personal'), 'urladdress__personal__url', TEXT),
+    ('Url3', 'url3', 'http://specs.nic.cz/attr/url/work',
+     ugettext_noop(u'URL – Work'), 'urladdress__office__url', TEXT),
+    ('RSS', 'rss', 'http://specs.nic.cz/attr/url/rss',
+     ugettext_noop(u'URL – RSS'), 'urladdress__rss__url', TEXT),
+    ('Facebook', 'fb', 'http://specs.nic.cz/attr/url/facebook',
+     ugettext_noop(u'URL – Facebook'), 'urladdress__facebook__url', TEXT),
+    ('Twitter', 'twitter', 'http://specs.nic.cz/attr/url/twitter',
+     ugettext_noop(u'URL – Twitter'), 'urladdress__twitter__url', TEXT),
+    ('LinkedIn', 'linkedin', 'http://specs.nic.cz/attr/url/linkedin',
+     ugettext_noop(u'URL – LinkedIN'), 'urladdress__linkedin__url', TEXT),
+    ('ICQ', 'icq', 'http://axschema.org/contact/IM/ICQ',
+     ugettext_noop(u'IM – ICQ'), 'imaccount__icq__username', TEXT),
+    ('Jabber', 'jabber', 'http://axschema.org/contact/IM/Jabber',
+     ugettext_noop(u'IM – Jabber'), 'imaccount__jabber__username', TEXT),
+    ('Skype', 'skype', 'http://axschema.org/contact/IM/Skype',
+     ugettext_noop(u'IM – Skype'), 'imaccount__skype__username', TEXT),
+    ('GoogleTalk', 'gtalk', 'http://specs.nic.cz/attr/im/google_talk',
+     ugettext_noop(u'IM – Google Talk'), 'imaccount__google_talk__username', TEXT),
+    ('WindowsLive', 'wlive', 'http://specs.nic.cz/attr/im/windows_live',
+     ugettext_noop(u'IM – Windows Live'), 'imaccout__windows_live__username', TEXT),
+    ('ICO', 'vat_id', 'http://specs.nic.cz/attr/contact/ident/vat_id',
+     ugettext_noop(u'Identifier – VAT Identification Number'), 'vat_id_num', TEXT),
+    ('DIC', 'vat', 'http://specs.nic.cz/attr/contact/vat',
+     ugettext_noop(u'Identifier – VAT registration Number'), 'vat_reg_num', TEXT),
+    ('IdentityCard', 'op', 'http://specs.nic.cz/attr/contact/ident/card',
+     ugettext_noop(u'Identifier – ID Card'), 'id_card_num', TEXT),
+    ('Passport', 'pas', 'http://specs.nic.cz/attr/contact/ident/pass',
+     ugettext_noop(u'Identifier – Passport'), 'passport_num', TEXT),
+    ('MPSV', 'mpsv', 'http://specs.nic.cz/attr/contact/ident/ssn',
+     ugettext_noop(u'Identifier – MPSV'), 'ssn_id_num', TEXT),
+    ('Student', 'student', 'http://specs.nic.cz/attr/contact/student',
+     ugettext_noop(u'Flag – Student'), None, BOOLEAN),
+    # Probably not supported anymore
+    ('Validated', 'validated', 'http://specs.nic.cz/attr/contact/valid',
+     ugettext_noop(u'Flag – Validation'), None, BOOLEAN),
+    # Probably not supported anymore
+    ('Status', 'status', 'http://specs.nic.cz/attr/contact/status',
+     ugettext_noop(u'Account State'), None, TEXT),
+    ('Adult', 'adult', 'http://specs.nic.cz/attr/contact/adult',
+     ugettext_noop(u'Flag – Adult'), None, BOOLEAN),
+    ('Image', 'image', 'http://specs.nic.cz/attr/contact/image',
+     ugettext_noop(u'Image (base64)'), None, IMAGE),
+)
+
+
+# The attributes are available as module members, e.g. declare.Email
+for _row in CATALOG:
+    globals()[_row[0]] = Declarator(_row[0])
+del _row
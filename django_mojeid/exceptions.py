@@ -65,3 +65,10 @@ class MissingPhysicalMultiFactor(DjangoOpenIDException):
 
     def __init__(self, message=message):
         super(MissingPhysicalMultiFactor, self).__init__(message)
+
+
+class ProviderUnavailable(DjangoOpenIDException):
+    message = _("The OpenID provider is temporarily unavailable.")
+
+    def __init__(self, message=message):
+        super(ProviderUnavailable, self).__init__(message)
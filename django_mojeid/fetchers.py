@@ -0,0 +1,392 @@
+# django-mojeid - mojeID integration for django
+#
+# Copyright (C) 2013 CZ.NIC
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""HTTP fetcher used for all outbound OpenID calls"""
+
+import httplib
+import re
+import select
+import socket
+import ssl
+import threading
+import time
+
+from urlparse import urljoin, urlsplit
+
+from django.conf import settings
+
+from openid import fetchers
+
+from django_mojeid.breaker import get_breaker
+from django_mojeid.exceptions import ProviderUnavailable
+
+# Redirects followed before the fetch is considered broken
+MAX_REDIRECTS = 5
+
+# The OpenID information is always placed in the <head> of a HTML
+# document, so the discovery doesn't need to read past it
+HTML_HEAD_END = re.compile(r'</head\s*>|<body\b', re.IGNORECASE)
+
+CHUNK_SIZE = 8192
+
+
+class DNSCache(object):
+    """ Cache of resolved addresses so that every fetch doesn't hit the resolver """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get((host, port))
+        if cached and cached[0] > now:
+            return cached[1]
+
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self._lock:
+            self._cache[(host, port)] = (now + self.ttl, addresses)
+        return addresses
+
+    def forget(self, host, port):
+        with self._lock:
+            self._cache.pop((host, port), None)
+
+    def create_connection(self, host, port, timeout):
+        """ Same as socket.create_connection but uses the cached addresses """
+        error = None
+        for family, socktype, proto, _, address in self.resolve(host, port):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.settimeout(timeout)
+                sock.connect(address)
+                return sock
+            except socket.error, error:
+                if sock is not None:
+                    sock.close()
+
+        # None of the cached addresses works, resolve again next time
+        self.forget(host, port)
+        raise error or socket.error('getaddrinfo returns an empty list')
+
+
+class PooledHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, host, port, fetcher):
+        httplib.HTTPConnection.__init__(self, host, port)
+        self.fetcher = fetcher
+
+    def _connect_socket(self):
+        return self.fetcher.dns_cache.create_connection(
+            self.host, self.port, self.fetcher.connect_timeout)
+
+    def connect(self):
+        self.sock = self._connect_socket()
+        self.sock.settimeout(self.fetcher.read_timeout)
+
+
+class PooledHTTPSConnection(PooledHTTPConnection):
+    default_port = httplib.HTTPS_PORT
+
+    def connect(self):
+        sock = self._connect_socket()
+        # The context is shared so the TLS configuration is loaded only once
+        self.sock = self.fetcher.ssl_context.wrap_socket(sock, server_hostname=self.host)
+        self.sock.settimeout(self.fetcher.read_timeout)
+
+
+class PooledHTTPFetcher(fetchers.HTTPFetcher):
+    """ Fetcher which keeps the connections to the hosts alive
+
+        Idle connections are stored per host and reused by the following
+        requests so only the first request to a host pays for the TCP and
+        TLS handshake.
+    """
+
+    connection_classes = {
+        'http': PooledHTTPConnection,
+        'https': PooledHTTPSConnection,
+    }
+
+    def __init__(self, connect_timeout=5, read_timeout=10, pool_size=4,
+                 dns_ttl=300, discovery_max_bytes=128 * 1024, discovery_timeout=10):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.discovery_max_bytes = discovery_max_bytes
+        self.discovery_timeout = discovery_timeout
+        self.dns_cache = DNSCache(dns_ttl)
+        self.ssl_context = ssl.create_default_context()
+        self._pool = {}
+        self._lock = threading.Lock()
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        return self.connection_classes[scheme](host, port, self)
+
+    def _get_connection(self, key):
+        while True:
+            with self._lock:
+                idle = self._pool.get(key)
+                if not idle:
+                    break
+                connection = idle.pop()
+
+            # An idle connection is readable only when the server has closed it
+            try:
+                closed = select.select([connection.sock], [], [], 0)[0]
+            except (select.error, socket.error, ValueError):
+                closed = True
+            if not closed:
+                return connection, True
+            connection.close()
+
+        return self._new_connection(key), False
+
+    def _release_connection(self, key, connection):
+        with self._lock:
+            idle = self._pool.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """ Close all idle connections """
+        with self._lock:
+            pool, self._pool = self._pool, {}
+        for idle in pool.itervalues():
+            for connection in idle:
+                connection.close()
+
+    def _read_body(self, response, limit, html_head_only, aborted=None, deadline=None):
+        """ Read at most `limit` bytes of the response body in chunks
+
+            The reading fails when `aborted` is set or after the `deadline`.
+            Returns the data and whether the whole body was read.
+        """
+        def timed_out():
+            return (aborted is not None and aborted.is_set()) or \
+                (deadline is not None and time.time() > deadline)
+
+        data = ''
+        while len(data) < limit:
+            try:
+                chunk = response.read(min(CHUNK_SIZE, limit - len(data)))
+            except (httplib.HTTPException, socket.error):
+                if timed_out():
+                    raise fetchers.HTTPFetchingError('Reading of the response timed out')
+                raise
+            if timed_out():
+                raise fetchers.HTTPFetchingError('Reading of the response timed out')
+            if not chunk:
+                return data, True
+
+            # The end of the head might be split between the chunks
+            start = max(0, len(data) - 16)
+            data += chunk
+            if html_head_only:
+                match = HTML_HEAD_END.search(data, start)
+                if match:
+                    return data[:match.start()], False
+
+        return data, response.isclosed() or not response.read(1)
+
+    def _read_discovery_body(self, sock, response):
+        """ Read the body within the discovery timeout
+
+            The socket timeout only limits the single reads, so the socket
+            is shut down when the reading takes too long as a whole. It is
+            the underlying socket of the request (the SSL object stays
+            intact), httplib closes the connection object itself when the
+            server doesn't keep the connection alive.
+        """
+        aborted = threading.Event()
+        deadline = time.time() + self.discovery_timeout
+
+        def abort():
+            aborted.set()
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        timer = threading.Timer(self.discovery_timeout, abort)
+        timer.daemon = True
+        timer.start()
+        try:
+            content_type = response.getheader('content-type', '')
+            data, complete = self._read_body(
+                response, self.discovery_max_bytes, 'html' in content_type, aborted, deadline)
+        finally:
+            timer.cancel()
+
+        # The connection can't be reused when it was shut down right after the reading
+        return data, complete and not aborted.is_set()
+
+    def _request(self, url, body, headers):
+        parsed = urlsplit(url)
+        key = (parsed.scheme, parsed.hostname,
+               parsed.port or self.connection_classes[parsed.scheme].default_port)
+
+        selector = parsed.path or '/'
+        if parsed.query:
+            selector += '?' + parsed.query
+        method = 'GET' if body is None else 'POST'
+
+        connection, reused = self._get_connection(key)
+        try:
+            sent = False
+            try:
+                connection.request(method, selector, body, headers)
+                sent = True
+                sock = connection.sock._sock
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                # A POST which was sent might have been processed already
+                # (e.g. check_authentication invalidates the handle)
+                if not reused or (sent and method == 'POST'):
+                    raise
+                # The server has closed the idle connection, try a new one
+                connection.close()
+                connection = self._new_connection(key)
+                connection.request(method, selector, body, headers)
+                sock = connection.sock._sock
+                response = connection.getresponse()
+
+            if method == 'GET':
+                # Discovery - stop reading as soon as the OpenID information is obtained
+                data, complete = self._read_discovery_body(sock, response)
+            else:
+                data, complete = self._read_body(
+                    response, fetchers.MAX_RESPONSE_KB * 1024, False)
+        except:
+            connection.close()
+            raise
+
+        if complete and not response.will_close:
+            self._release_connection(key, connection)
+        else:
+            # The body wasn't read whole or the server doesn't keep the
+            # connection alive, it can't be reused
+            connection.close()
+
+        return fetchers.HTTPResponse(
+            final_url=url,
+            status=response.status,
+            headers=dict(response.getheaders()),
+            body=data,
+        )
+
+    def fetch(self, url, body=None, headers=None):
+        if not fetchers._allowedURL(url):
+            raise ValueError('Bad URL scheme: %r' % (url,))
+
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', fetchers.USER_AGENT)
+
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(url, body, headers)
+            location = response.headers.get('location')
+            if response.status not in (301, 302, 303, 307) or not location:
+                return response
+
+            url = urljoin(url, location)
+            if not fetchers._allowedURL(url):
+                raise ValueError('Bad URL scheme: %r' % (url,))
+            if response.status != 307:
+                # Behave like urllib2 - the redirected request is always GET
+                body = None
+                headers.pop('Content-Type', None)
+
+        raise fetchers.HTTPFetchingError('Too many redirects (%d)' % MAX_REDIRECTS)
+
+
+class GuardedFetcher(fetchers.HTTPFetcher):
+    """ Fetcher wrapper which protects the workers from a slow OpenID provider
+
+        Every endpoint has its own circuit breaker and the number of
+        concurrent outbound calls made by the process is capped.
+    """
+
+    def __init__(self, fetcher, max_concurrent=None):
+        self.fetcher = fetcher
+        self._slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+
+    def fetch(self, url, body=None, headers=None):
+        # Don't wait for a free slot, fail immediately
+        if self._slots and not self._slots.acquire(False):
+            raise ProviderUnavailable()
+
+        try:
+            breaker = get_breaker(url)
+            if not breaker.allow():
+                raise ProviderUnavailable()
+
+            start = time.time()
+            try:
+                response = self.fetcher.fetch(url, body, headers)
+            except Exception:
+                breaker.record_failure()
+                raise
+        finally:
+            if self._slots:
+                self._slots.release()
+
+        if response.status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success(time.time() - start)
+
+        return response
+
+
+def install_fetcher():
+    """ Replace the default python-openid fetcher
+
+        PooledHTTPFetcher is used unless disabled and it is guarded
+        by GuardedFetcher.
+    """
+    if getattr(settings, 'OPENID_USE_POOLED_FETCHER', True):
+        fetcher = PooledHTTPFetcher(
+            connect_timeout=getattr(settings, 'OPENID_FETCHER_CONNECT_TIMEOUT', 5),
+            read_timeout=getattr(settings, 'OPENID_FETCHER_READ_TIMEOUT', 10),
+            pool_size=getattr(settings, 'OPENID_FETCHER_POOL_SIZE', 4),
+            dns_ttl=getattr(settings, 'OPENID_FETCHER_DNS_TTL', 300),
+            discovery_max_bytes=getattr(settings, 'OPENID_DISCOVERY_MAX_BYTES', 128 * 1024),
+            discovery_timeout=getattr(settings, 'OPENID_DISCOVERY_TIMEOUT', 10),
+        )
+    else:
+        fetcher = fetchers.createHTTPFetcher()
+
+    fetcher = GuardedFetcher(
+        fetcher, max_concurrent=getattr(settings, 'OPENID_MAX_CONCURRENT_FETCHES', None))
+    fetchers.setDefaultFetcher(fetcher)
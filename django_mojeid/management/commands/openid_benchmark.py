@@ -0,0 +1,183 @@
+# django-openid-auth -  OpenID integration for django.contrib.auth
+#
+# Copyright (C) 2013 CZ.NIC
+# Copyright (C) 2009-2013 Canonical Ltd.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Measure the cost of the OpenID operations
+
+The cost of a login is measured in the smart and in the stateless mode and
+the CPU cost of an association for each association and session type.
+
+The operations are made against an in-process python-openid server, so the
+numbers don't include the network. Use --rtt to add a simulated round trip
+to every call made to the server. The logins are measured in wall-clock
+time. The CPU time spent by the server is not included in the association
+cost and the associations don't use the pool of Diffie-Hellman keys, so the
+cost includes the key generation.
+"""
+
+import time
+
+from optparse import make_option
+from urlparse import parse_qsl, urlsplit
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from openid import fetchers
+from openid.association import SessionNegotiator, default_association_order
+from openid.consumer.consumer import Consumer, GenericConsumer, SUCCESS
+from openid.consumer.discover import OpenIDServiceEndpoint, OPENID_2_0_TYPE
+from openid.server.server import Server
+from openid.store.memstore import MemoryStore
+
+from django_mojeid.consumer import SecureSessionConsumer
+from django_mojeid.models import Association, Nonce
+from django_mojeid.store import DjangoOpenIDStore, SMART_MODE, STATELESS_MODE
+
+SERVER_URL = 'https://openid-benchmark.invalid/endpoint/'
+IDENTITY = 'https://user.openid-benchmark.invalid/'
+REALM = 'https://rp.openid-benchmark.invalid/'
+RETURN_TO = REALM + 'complete/'
+
+
+class LoopbackFetcher(fetchers.HTTPFetcher):
+    """ Passes the direct requests to the in-process server """
+
+    def __init__(self, server, rtt):
+        self.server = server
+        self.rtt = rtt
+        self.calls = 0
+        self.server_time = 0.0
+
+    def fetch(self, url, body=None, headers=None):
+        self.calls += 1
+        time.sleep(self.rtt)
+        start = time.clock()
+        request = self.server.decodeRequest(dict(parse_qsl(body or '')))
+        response = self.server.encodeResponse(self.server.handleRequest(request))
+        self.server_time += time.clock() - start
+        return fetchers.HTTPResponse(url, response.code, response.headers, response.body)
+
+
+def make_endpoint():
+    endpoint = OpenIDServiceEndpoint()
+    endpoint.server_url = SERVER_URL
+    endpoint.claimed_id = endpoint.local_id = IDENTITY
+    endpoint.type_uris = [OPENID_2_0_TYPE]
+    return endpoint
+
+
+class Command(BaseCommand):
+    help = 'Compare the cost of the logins and the associations'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--logins', type='int', default=200,
+                    help='Number of logins in each mode'),
+        make_option('--rtt', type='float', default=0.0,
+                    help='Simulated round trip time to the OpenID server in ms'),
+        make_option('--associations', type='int', default=50,
+                    help='Number of associations for each association type'),
+    )
+
+    def login(self, server, store):
+        consumer = Consumer({}, store, consumer_class=SecureSessionConsumer)
+        auth_request = consumer.beginWithoutDiscovery(make_endpoint())
+        query = dict(parse_qsl(urlsplit(auth_request.redirectURL(REALM, RETURN_TO)).query))
+
+        # The user confirms the login on the server
+        server_request = server.decodeRequest(query)
+        answer = server.encodeResponse(server_request.answer(True, identity=IDENTITY))
+        query = dict(parse_qsl(urlsplit(answer.headers['location']).query))
+
+        response = consumer.complete(query, RETURN_TO)
+        if response.status != SUCCESS:
+            raise RuntimeError('Login failed: %s' % getattr(response, 'message', response.status))
+
+    def run_logins(self, mode, logins, rtt):
+        server = Server(MemoryStore(), SERVER_URL)
+        fetcher = LoopbackFetcher(server, rtt)
+        store = DjangoOpenIDStore() if mode == SMART_MODE else None
+
+        original_fetcher = fetchers.getDefaultFetcher()
+        fetchers.setDefaultFetcher(fetcher, wrap_exceptions=False)
+        queries = len(connection.queries)
+        try:
+            start = time.time()
+            for _ in range(logins):
+                self.login(server, store)
+            elapsed = time.time() - start
+            queries = len(connection.queries) - queries
+        finally:
+            fetchers.setDefaultFetcher(original_fetcher, wrap_exceptions=False)
+            Association.objects.filter(server_url=SERVER_URL).delete()
+            Nonce.objects.filter(server_url=SERVER_URL).delete()
+
+        self.stdout.write('%-10s %8.3f ms/login %6.2f calls/login %6.2f queries/login\n' % (
+            mode,
+            elapsed * 1000 / logins,
+            float(fetcher.calls) / logins,
+            float(queries) / logins,
+        ))
+
+    def run_associations(self, assoc_type, session_type, associations):
+        server = Server(MemoryStore(), SERVER_URL)
+        fetcher = LoopbackFetcher(server, 0)
+        consumer = SecureSessionConsumer(None)
+        # The pooled keys would hide the cost of the key generation
+        consumer.session_types = GenericConsumer.session_types
+        consumer.negotiator = SessionNegotiator([(assoc_type, session_type)])
+        endpoint = make_endpoint()
+
+        original_fetcher = fetchers.getDefaultFetcher()
+        fetchers.setDefaultFetcher(fetcher, wrap_exceptions=False)
+        try:
+            # CPU time of the process, the pool thread of the keys is not used
+            start = time.clock()
+            for _ in range(associations):
+                if consumer._negotiateAssociation(endpoint) is None:
+                    raise RuntimeError('Association %s/%s failed' % (assoc_type, session_type))
+            elapsed = time.clock() - start - fetcher.server_time
+        finally:
+            fetchers.setDefaultFetcher(original_fetcher, wrap_exceptions=False)
+
+        self.stdout.write('%-14s %-14s %8.3f ms CPU/association (no DH pool)\n' % (
+            assoc_type, session_type, elapsed * 1000 / associations))
+
+    def handle(self, **options):
+        # Queries are counted only when the debug cursor is used
+        # (the attribute was renamed in django 1.8)
+        connection.use_debug_cursor = True
+        connection.force_debug_cursor = True
+
+        if options['logins']:
+            for mode in (SMART_MODE, STATELESS_MODE):
+                self.run_logins(mode, options['logins'], options['rtt'] / 1000.0)
+
+        if options['associations']:
+            for assoc_type, session_type in default_association_order:
+                self.run_associations(assoc_type, session_type, options['associations'])
@@ -0,0 +1,77 @@
+# django-openid-auth -  OpenID integration for django.contrib.auth
+#
+# Copyright (C) 2013 CZ.NIC
+# Copyright (C) 2009-2013 Canonical Ltd.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Update the models from the pending mojeID profile snapshots
+
+Run it periodically (e.g. from cron) when MOJEID_PROFILE_SNAPSHOTS is set.
+Each batch of snapshots is applied in a single transaction, every snapshot
+in a savepoint of its own. A snapshot which fails is logged and skipped, it
+is tried again by the next run.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
+from django_mojeid.auth import OpenIDBackend
+from django_mojeid.models import MojeIDProfile
+
+
+class Command(BaseCommand):
+    help = 'Update the models from the pending mojeID profile snapshots'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help='Number of snapshots applied in one transaction'),
+    )
+
+    def handle(self, **options):
+        batch_size = options['batch_size']
+        last_pk = 0
+        count = 0
+
+        while True:
+            with atomic():
+                batch = list(MojeIDProfile.objects.filter(materialized=False, pk__gt=last_pk)
+                             .order_by('pk')[:batch_size])
+                for profile in batch:
+                    if OpenIDBackend.materialize_profile(profile):
+                        count += 1
+
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('%d profiles materialized\n' % count)
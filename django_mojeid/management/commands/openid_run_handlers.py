@@ -0,0 +1,126 @@
+# django-openid-auth -  OpenID integration for django.contrib.auth
+#
+# Copyright (C) 2013 CZ.NIC
+# Copyright (C) 2009-2013 Canonical Ltd.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Run the queued calls of the deferred attribute handlers
+
+Run it periodically (e.g. from cron) or with --loop as a worker.
+A batch of calls is claimed in a short transaction, so the workers don't
+run the same calls, then every call runs in its own transaction. A batch
+handler gets all its calls from the batch at once.
+"""
+
+import time
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
+from django_mojeid.attribute_handlers import HandlerNotFound, logger, run_queued_calls
+from django_mojeid.models import HandlerCall
+
+
+class Command(BaseCommand):
+    help = 'Run the queued calls of the deferred attribute handlers'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help='Number of calls processed in one transaction'),
+        make_option('--max-attempts', type='int', default=5,
+                    help='Calls which failed this many times are not run anymore'),
+        make_option('--loop', action='store_true', default=False,
+                    help='Keep waiting for new calls'),
+        make_option('--interval', type='float', default=5,
+                    help='Seconds to wait for new calls with --loop'),
+        make_option('--claim-timeout', type='int', default=600,
+                    help='Seconds after which the calls of a stopped worker are run again'),
+    )
+
+    def claim_batch(self, last_pk, batch_size, max_attempts, claim_timeout):
+        """ Mark a batch of calls as running, the attempt is counted even if the worker dies """
+        now = int(time.time())
+        with atomic():
+            batch = list(HandlerCall.objects.select_for_update()
+                         .filter(pk__gt=last_pk, attempts__lt=max_attempts,
+                                 claimed__lt=now - claim_timeout)
+                         .order_by('pk')[:batch_size])
+            HandlerCall.objects.filter(pk__in=[call.pk for call in batch]) \
+                .update(attempts=F('attempts') + 1, claimed=now)
+        return batch
+
+    def run_batch(self, batch):
+        by_handler = {}
+        for call in batch:
+            by_handler.setdefault(call.handler, []).append(call)
+
+        failed = []
+        for handler_name, calls in by_handler.iteritems():
+            try:
+                failed.extend(run_queued_calls(handler_name, calls))
+            except HandlerNotFound:
+                logger.error('Handler %s is not registered', handler_name)
+                failed.extend(calls)
+
+        # The failed calls are released for the next attempt
+        failed_pks = [call.pk for call in failed]
+        with atomic():
+            HandlerCall.objects.filter(pk__in=failed_pks).update(claimed=0)
+            HandlerCall.objects.filter(pk__in=[call.pk for call in batch]) \
+                .exclude(pk__in=failed_pks).delete()
+
+        return len(batch) - len(failed)
+
+    def handle(self, **options):
+        batch_size = options['batch_size']
+        max_attempts = options['max_attempts']
+        last_pk = 0
+        count = 0
+
+        while True:
+            batch = self.claim_batch(last_pk, batch_size, max_attempts,
+                                     options['claim_timeout'])
+            done = self.run_batch(batch)
+            count += done
+
+            if batch:
+                last_pk = batch[-1].pk
+            elif options['loop']:
+                # The failed calls are retried in the next round
+                last_pk = 0
+                time.sleep(options['interval'])
+            else:
+                break
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('%d handler calls run\n' % count)
@@ -95,3 +95,53 @@ class UserOpenID(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+class UserAttributeSync(models.Model):
+    """ State of the synchronization of the attributes of a user """
+    user_id = models.IntegerField()
+    attribute_set = models.CharField(max_length=255)
+    fingerprints = models.TextField(default='{}')  # JSON {model label: fingerprint}
+    synced = models.IntegerField(default=0)  # timestamp of the last synchronization
+
+    class Meta:
+        unique_together = ('user_id', 'attribute_set')
+
+    def __unicode__(self):
+        return u"UserAttributeSync: %s, %s" % (self.user_id, self.attribute_set)
+
+
+class MojeIDProfile(models.Model):
+    """ Snapshot of the attributes of a user returned by mojeID """
+    user_id = models.IntegerField()
+    attribute_set = models.CharField(max_length=255)
+    values = models.TextField()  # JSON {schema: [value, ...]}
+    updated = models.IntegerField()  # timestamp of the login which stored the values
+    materialized = models.BooleanField(default=False)  # whether the models are up to date
+
+    class Meta:
+        unique_together = ('user_id', 'attribute_set')
+
+    def __unicode__(self):
+        return u"MojeIDProfile: %s, %s" % (self.user_id, self.attribute_set)
+
+
+class HandlerCall(models.Model):
+    """ Queued call of a deferred attribute handler """
+    handler = models.CharField(max_length=255)
+    user_id = models.IntegerField()
+    value = models.TextField()  # JSON
+    created = models.IntegerField()  # timestamp of the login
+    attempts = models.IntegerField(default=0)  # number of the runs which were started
+    claimed = models.IntegerField(default=0)  # timestamp of the running attempt
+
+    def __unicode__(self):
+        return u"HandlerCall: %s, %s" % (self.handler, self.user_id)
+
+
+# Django >= 1.7 installs the OpenID fetcher in MojeIDConfig.ready,
+# the older versions once the models are loaded
+import django
+if django.VERSION < (1, 7):
+    from django_mojeid.fetchers import install_fetcher
+    install_fetcher()
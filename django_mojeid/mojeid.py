@@ -29,76 +29,399 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import binascii
+import hashlib
+import re
+import tempfile
+import threading
+
+from collections import namedtuple
+from importlib import import_module
+
 from django.conf import settings
 from django.core.exceptions import FieldError, ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import default_storage, get_storage_class
 from django.http import Http404
+from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext
 
-from openid.extensions import ax
+from openid.extension import Extension
+from openid.extensions import ax, pape
 
+from django_mojeid import declare
+from django_mojeid.declare import BOOLEAN, CATALOG, IMAGE, TEXT
 from django_mojeid.exceptions import RequiredAttributeNotReturned
 
 MOJEID_ENDPOINT_URL = 'https://mojeid.fred.nic.cz/endpoint/'
 MOJEID_REGISTRATION_URL = 'https://mojeid.fred.nic.cz/registration/endpoint/'
 
 
-def get_attributes(attribute_set):
+class PrebuiltExtension(Extension):
+    """ Extension which arguments are serialized only once """
+
+    def __init__(self, extension):
+        self.ns_uri = extension.ns_uri
+        self.ns_alias = extension.ns_alias
+        self.args = extension.getExtensionArgs()
+
+    def getExtensionArgs(self):
+        return self.args
 
+
+class ResponseValues(object):
+    """ AX values and PAPE policies of a verified response
+
+        The AX values are indexed by their schema. The images are given
+        by the names of their files in image_refs, a new image is written
+        to the storage only by save_image (a profile snapshot keeps just
+        the names of images which are stored already).
+    """
+
+    def __init__(self, data=None, auth_policies=(), image_refs=None):
+        self.data = data or {}
+        self.auth_policies = tuple(auth_policies)
+        self.image_refs = image_refs or {}
+        # {name: base64 data} of the images which may not be saved yet
+        self.pending_images = {}
+
+    @classmethod
+    def parse(cls, openid_response):
+        """ Walk the message only once, arguments of a namespace which
+            are not all signed are ignored
+        """
+        message = openid_response.message
+        signed_fields = frozenset(openid_response.signed_fields)
+
+        namespaces = {ax.AXMessage.ns_uri: {}, pape.ns_uri: {}}
+        unsigned = set()
+        for (ns_uri, key), value in message.args.iteritems():
+            args = namespaces.get(ns_uri)
+            if args is None:
+                continue
+            args[key] = value
+            if message.getKey(ns_uri, key) not in signed_fields:
+                unsigned.add(ns_uri)
+
+        data = {}
+        ax_args = namespaces[ax.AXMessage.ns_uri]
+        if ax_args and ax.AXMessage.ns_uri not in unsigned:
+            fetch_response = ax.FetchResponse()
+            try:
+                fetch_response.parseExtensionArgs(ax_args)
+            except ax.NotAXMessage:
+                pass
+            else:
+                data = fetch_response.data
+
+        auth_policies = ()
+        pape_args = namespaces[pape.ns_uri]
+        if pape_args and pape.ns_uri not in unsigned:
+            pape_response = pape.Response()
+            pape_response.parseExtensionArgs(pape_args, openid_response.isOpenID1())
+            auth_policies = pape_response.auth_policies
+
+        return cls(data, auth_policies)
+
+    def get(self, type_uri):
+        return self.data.get(type_uri, [])
+
+    def get_image(self, type_uri):
+        """ Name of the file of the image, None when it is missing or invalid """
+        if type_uri not in self.image_refs:
+            name = None
+            prepared = prepare_image(self.getSingle(type_uri, None))
+            if prepared:
+                name, self.pending_images[name] = prepared
+            self.image_refs[type_uri] = name
+        return self.image_refs[type_uri]
+
+    def save_image(self, name):
+        """ Save the image to the file storage unless it is there already
+
+            Concurrent writes of the same image may store more copies,
+            but the file of the name always holds the image.
+        """
+        data = self.pending_images.pop(name, None)
+        if data is not None:
+            save_image(name, data)
+
+    def getSingle(self, type_uri, default=None):
+        # Same semantics as ax.FetchResponse.getSingle
+        values = self.data.get(type_uri)
+        if not values:
+            return default
+        if len(values) == 1:
+            return values[0]
+        raise ax.AXError('More than one value present for %r' % (type_uri, ))
+
+
+def get_response_values(openid_response):
+    """ Values of the response, parsed only on the first call
+
+        ResponseValues (e.g. restored from a profile snapshot) are returned as they are.
+    """
+    if isinstance(openid_response, ResponseValues):
+        return openid_response
+    values = getattr(openid_response, '_mojeid_values', None)
+    if values is None:
+        values = ResponseValues.parse(openid_response)
+        openid_response._mojeid_values = values
+    return values
+
+
+class AttributeSet(object):
+    """ Immutable precompiled set of attributes
+
+        The attributes are validated and filtered once when the set is built
+        so the callers only do lookups.
+    """
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = tuple(attributes)
+        self.handlers = tuple(x for x in self.attributes if x.type == 'handler')
+        self.model_attributes = tuple(x for x in self.attributes if x.type == 'attribute')
+        self.updatable_attributes = tuple(x for x in self.model_attributes if x.updatable)
+
+        # ((model, user_id_field_name, (attribute, ...)), ...)
+        self.models = self._group_by_model(self.model_attributes)
+        self.updatable_models = self._group_by_model(self.updatable_attributes)
+
+        # ((attribute, required), ...) without duplicities
+        self.query = self._build_query(self.attributes)
+
+        # Extensions added to every authentication request
+        self.extensions = self._build_extensions(self.query)
+
+        # Only the attributes which are used when an existing user logs in
+        self.update_query = self._build_query(self.updatable_attributes + self.handlers)
+        self.update_extensions = self._build_extensions(self.update_query)
+
+        # The attributes used to prefill the registration form
+        self.registration_attributes = tuple(
+            x for x in self.model_attributes
+            if hasattr(x, 'registration_field') and x.use_for_registration)
+        self.registration_models = tuple(
+            (model, user_id_field_name, tuple(x.modelAttribute for x in attributes))
+            for model, user_id_field_name, attributes
+            in self._group_by_model(filter(self._is_prefetchable, self.registration_attributes)))
+
+        self._validate()
+
+    @staticmethod
+    def _group_by_model(attributes):
+        groups = []
+        used_dict = {}
+        for attribute in attributes:
+            if attribute.model not in used_dict:
+                used_dict[attribute.model] = len(groups)
+                groups.append((attribute.model, attribute.user_id_field_name, []))
+            groups[used_dict[attribute.model]][2].append(attribute)
+
+        return tuple((model, user_id_field_name, tuple(attributes))
+                     for model, user_id_field_name, attributes in groups)
+
+    @staticmethod
+    def _is_prefetchable(attribute):
+        # The record can't be shared when the attribute looks it up on its own
+        cls = type(attribute)
+        return cls._get_record.im_func is MojeIDAttribute._get_record.im_func and \
+            cls._get_model_value.im_func is MojeIDAttribute._get_model_value.im_func
+
+    def registration_fields_html(self, user_id):
+        """ Prefilled registration fields, each model is queried only once """
+        records = {}
+        for model, user_id_field_name, field_names in self.registration_models:
+            field_names = [x for x in field_names if x != 'pk']
+            try:
+                records[model] = model.objects.only(*field_names).get(
+                    **{user_id_field_name: user_id})
+            except model.DoesNotExist:
+                pass
+
+        fields = []
+        for attribute in self.registration_attributes:
+            record = records.get(attribute.model) if self._is_prefetchable(attribute) else None
+            form_attr = attribute.registration_form_attrs_html(user_id, record)
+            if form_attr:
+                fields.append(form_attr)
+        return fields
+
+    @staticmethod
+    def _build_query(attributes):
+        used_dict = {}
+        filtered_attributes = []
+        for attribute in attributes:
+
+            required = attribute.required
+            attribute = attribute.attribute if attribute.type == 'handler' else attribute
+
+            if attribute.code in used_dict:
+                if not filtered_attributes[used_dict[attribute.code]][1]:
+                    # required=true has higher priority
+                    filtered_attributes[used_dict[attribute.code]] = (attribute, required, )
+            else:
+                used_dict[attribute.code] = len(filtered_attributes)
+                filtered_attributes.append((attribute, required, ))
+
+        return tuple(filtered_attributes)
+
+    @staticmethod
+    def _build_extensions(query):
+        extensions = []
+
+        # Request user details.
+        if query:
+            fetch_request = ax.FetchRequest()
+            for attribute, required in query:
+                fetch_request.add(attribute.generate_ax_attrinfo(required))
+            extensions.append(PrebuiltExtension(fetch_request))
+
+        if getattr(settings, 'OPENID_PHYSICAL_MULTIFACTOR_REQUIRED', False):
+            preferred_auth = [
+                pape.AUTH_MULTI_FACTOR_PHYSICAL,
+            ]
+            extensions.append(PrebuiltExtension(pape.Request(preferred_auth_policies=preferred_auth)))
+
+        return tuple(extensions)
+
+    def _validate(self):
+        for model, user_id_field_name, attributes in self.models:
+            field_names = set(field.name for field in model._meta.fields)
+            field_names.update(field.attname for field in model._meta.fields)
+            field_names.add('pk')
+
+            for attribute in attributes:
+                if attribute.user_id_field_name != user_id_field_name:
+                    raise ImproperlyConfigured(
+                        _("Attributes of model '%(model)s' in set '%(set)s' use different user id fields.")
+                        % {'model': model.__name__, 'set': self.name})
+                # The value may be written through a property or an overridden _set
+                if attribute.user_id_field_name not in field_names:
+                    missing = attribute.user_id_field_name
+                elif attribute.modelAttribute not in field_names and \
+                        not hasattr(model, attribute.modelAttribute) and \
+                        type(attribute)._set.__func__ is MojeIDAttribute._set.__func__:
+                    missing = attribute.modelAttribute
+                else:
+                    continue
+                raise ImproperlyConfigured(
+                    _("Model '%(model)s' has no field '%(field)s'.")
+                    % {'model': model.__name__, 'field': missing})
+
+
+_attribute_sets = None
+_attribute_sets_lock = threading.Lock()
+
+
+def _build_attribute_sets():
     default = getattr(settings, 'MOJEID_ATTRIBUTES', [])
-    res = getattr(settings, 'MOJEID_ATTRIBUTES_SETS', {})
+    sets = dict(getattr(settings, 'MOJEID_ATTRIBUTES_SETS', {}))
 
     # MOJEID_ATTRIBUTES are default when present
-    if default or not res:
-        res['default'] = default
+    if default or not sets:
+        sets['default'] = default
+
+    return dict((name, AttributeSet(name, [resolve_declaration(x) for x in attributes]))
+                for name, attributes in sets.iteritems())
+
+
+def resolve_declaration(declaration):
+    """ Turn a declaration from *django_mojeid.declare* into an attribute """
+    if isinstance(declaration, declare.Declarator):
+        return _get_factory(declaration.factory)
+    if not isinstance(declaration, declare.Declaration):
+        return declaration
+
+    args = [resolve_declaration(x) for x in declaration.args]
+    return _get_factory(declaration.factory)(*args, **declaration.kwargs)
+
+
+def _get_factory(name):
+    if '.' not in name:
+        return globals()[name]
+
+    module_name, class_name = name.rsplit('.', 1)
+    try:
+        return getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError):
+        raise ImproperlyConfigured(_("Attribute class '%(class)s' does not exist.")
+                                   % {'class': name})
+
 
+def _reset_attribute_sets(**kwargs):
+    global _attribute_sets
+    if kwargs['setting'] in ('MOJEID_ATTRIBUTES', 'MOJEID_ATTRIBUTES_SETS',
+                             'OPENID_PHYSICAL_MULTIFACTOR_REQUIRED'):
+        _attribute_sets = None
+
+
+def get_attribute_sets():
+    """ Return all the attribute sets, they are built during the first call """
+    global _attribute_sets
+    if _attribute_sets is None:
+        with _attribute_sets_lock:
+            if _attribute_sets is None:
+                _attribute_sets = _build_attribute_sets()
+
+                # Rebuild the sets when the settings are overridden in the tests
+                from django.test.signals import setting_changed
+                setting_changed.connect(_reset_attribute_sets,
+                                        dispatch_uid='mojeid_attribute_sets')
+
+    return _attribute_sets
+
+
+def get_attribute_set(attribute_set):
     try:
-        return res[attribute_set]
+        return get_attribute_sets()[attribute_set]
     except KeyError:
         raise Http404
 
 
-def get_attribute_query(attribute_set='defualt'):
-    """ Return attributes without duplicities """
-    attributes = get_attributes(attribute_set)
+def get_attributes(attribute_set):
+    return get_attribute_set(attribute_set).attributes
 
-    used_dict = {}
-    filtered_attributes = []
-    for attribute in attributes:
 
-        required = attribute.required
-        attribute = attribute.attribute if attribute.type == 'handler' else attribute
+def get_attribute_query(attribute_set='default'):
+    """ Return attributes without duplicities """
+    return get_attribute_set(attribute_set).query
 
-        if attribute.code in used_dict:
-            if not filtered_attributes[used_dict[attribute.code]][1]:
-                # required=true has higher priority
-                filtered_attributes[used_dict[attribute.code]] = (attribute, required, )
-        else:
-            used_dict[attribute.code] = len(filtered_attributes)
-            filtered_attributes.append((attribute, required, ))
 
-    return filtered_attributes
+# Description of an attribute provided by mojeID
+AttributeSpec = namedtuple('AttributeSpec', 'code schema text registration_field kind')
 
 
 class CustomHandler(object):
+    __slots__ = ('attribute', 'name', 'required')
     type = 'handler'
 
     def __init__(self, attribute, name, required=True):
         self.name = name
         self.required = required
+        # The attribute (e.g. mojeid.FullName) is not bound to any model
+        if not isinstance(attribute, MojeIDAttribute):
+            attribute = attribute(None, None, None)
         self.attribute = attribute
 
 
 class MojeIDAttribute(object):
-    type = 'attribute'
+    """ Attribute of mojeID bound to a field of a model
 
-    code = None
-    schema = None
-    text = None
+        The description of the attribute (code, schema, text, ...) is shared
+        with all the other attributes of the same kind.
+    """
+
+    __slots__ = ('spec', 'modelApp', 'modelClass', 'modelAttribute', 'user_id_field_name',
+                 'required', 'updatable', 'use_for_registration', '_model')
+    type = 'attribute'
 
     def __init__(self, modelApp, modelClass, modelAttribute,
                  user_id_field_name='user_id', required=True,
-                 updatable=False, use_for_registration=True):
+                 updatable=False, use_for_registration=True, spec=None):
+        self.spec = spec
         self.modelClass = modelClass
         self.modelApp = modelApp
         self.modelAttribute = modelAttribute
@@ -108,6 +431,39 @@ class MojeIDAttribute(object):
         self.use_for_registration = use_for_registration
         self._model = None
 
+        if spec is None:
+            missing = [x for x in ('code', 'schema', 'text')
+                       if getattr(type(self), x) is getattr(MojeIDAttribute, x)]
+            if missing:
+                raise ImproperlyConfigured(
+                    _("Attribute '%(class)s' for '%(model)s.%(field)s' does not define %(missing)s.")
+                    % {'class': type(self).__name__, 'model': modelClass, 'field': modelAttribute,
+                       'missing': ', '.join(missing)})
+
+    # The subclasses might define these as class attributes instead of the spec
+
+    @property
+    def code(self):
+        return self.spec.code
+
+    @property
+    def schema(self):
+        return self.spec.schema
+
+    @property
+    def text(self):
+        return ugettext(self.spec.text)
+
+    @property
+    def registration_field(self):
+        if self.spec.registration_field is None:
+            raise AttributeError('registration_field')
+        return self.spec.registration_field
+
+    @property
+    def kind(self):
+        return self.spec.kind if self.spec else TEXT
+
     @property
     def model(self):
         if not self._model:
@@ -131,9 +487,16 @@ class MojeIDAttribute(object):
         return self.model.objects.get(**packed)
 
     # This method could be overwritten using inheritance
-    @classmethod
-    def _get_value(cls, response):
-        return response.getSingle(cls.schema, None)
+    def _get_value(self, response):
+        if self.kind == IMAGE:
+            # The image is saved when the name is written to the model
+            return response.get_image(self.schema)
+        value = response.getSingle(self.schema, None)
+        if value is None:
+            return None
+        if self.kind == BOOLEAN:
+            return value.lower() == 'true'
+        return value
 
     def set_model_value(self, id, value):
         record = self._get_record(id)
@@ -147,39 +510,38 @@ class MojeIDAttribute(object):
     def _get_model_value(self, id):
         return getattr(self._get_record(id), self.modelAttribute)
 
-    @classmethod
-    def generate_ax_attrinfo(cls, required):
-        return ax.AttrInfo(cls.schema, alias=cls.code, required=required)
+    def generate_ax_attrinfo(self, required):
+        return ax.AttrInfo(self.schema, alias=self.code, required=required)
 
-    @classmethod
-    def get_value(cls, response, required):
-        value = cls._get_value(response)
+    def get_value(self, response, required):
+        value = self._get_value(response)
         if required and value is None:
             raise RequiredAttributeNotReturned(
                 ugettext("Required Attribute '%(code)s' (%(text)s) was not returned.")
-                % {"code": unicode(cls.code), "text": unicode(cls.text)}
+                % {"code": unicode(self.code), "text": force_text(self.text)}
             )
         return value
 
-    def registration_form_attrs(self, id):
+    def registration_form_attrs(self, id, record=None):
         # Return none if registration field is not present
         if not hasattr(self, 'registration_field') or not self.use_for_registration:
             return None
 
-        value = self._get_model_value(id)
+        # The record might be already fetched for the whole attribute set
+        value = self._get_model_value(id) if record is None else getattr(record, self.modelAttribute)
         # No value present
         if value is None:
             return None
 
-        return {'name': self.registration_field, 'label': self.text.decode('utf-8'), 'value': value}
+        return {'name': self.registration_field, 'label': force_text(self.text), 'value': value}
 
     # This method could be overwritten using inheritance
     def _get_form_html_template(self):
         return u'<label for="%s">%s</label><input type="text" name="%s" value="%s">'
 
-    def registration_form_attrs_html(self, id):
+    def registration_form_attrs_html(self, id, record=None):
 
-        field = self.registration_form_attrs(id)
+        field = self.registration_form_attrs(id, record)
 
         # Field was not obtained.
         if not field:
@@ -191,463 +553,112 @@ class MojeIDAttribute(object):
 
 
 class MojeIDBooleanAttribute(MojeIDAttribute):
-
-    @classmethod
-    def _get_value(self, response):
-        res = response.getSingle(self.schema, None)
-        if res is None:
-            return None
-        return True if res.lower() == 'true' else False
-
-
-class BirthDate(MojeIDAttribute):
-    code = 'birthdate'
-    schema = 'http://axschema.org/birthDate'
-    text = _(u'Birth Date')  # 'Datum Narození'
-    registration_field = 'birth_date'
-
-
-class FullName(MojeIDAttribute):
-    code = 'fullname'
-    schema = 'http://axschema.org/namePerson'
-    text = _(u'Full Name')  # 'Celé jméno'
-
-
-class FirstName(MojeIDAttribute):
-    code = 'firstname'
-    schema = 'http://axschema.org/namePerson/first'
-    text = _(u'First Name')  # 'Jméno'
-    registration_field = 'first_name'
-
-
-class LastName(MojeIDAttribute):
-    code = 'lastname'
-    schema = 'http://axschema.org/namePerson/last'
-    text = _(u'Last Name')  # 'Příjmení'
-    registration_field = 'last_name'
-
-
-class NickName(MojeIDAttribute):
-    code = 'nick'
-    schema = 'http://axschema.org/namePerson/friendly'
-    text = _(u'Nick Name')  # 'Přezdívka'
-    registration_field = 'username'
-
-
-class Company(MojeIDAttribute):
-    code = 'company'
-    schema = 'http://axschema.org/company/name'
-    text = _(u'Company')  # 'Jméno společnosti'
-    registration_field = 'organization'
-
-
-class HomeAddress(MojeIDAttribute):
-    code = 'h_address'
-    schema = 'http://axschema.org/contact/postalAddress/home'
-    text = _(u'Home Address – Street')  # 'Domácí adresa – Ulice'
-    registration_field = 'address__default__street1'
-
-
-class HomeAddress2(MojeIDAttribute):
-    code = 'h_address2'
-    schema = 'http://axschema.org/contact/postalAddressAdditional/home'
-    text = _(u'Home Address – Street2')  # 'Domácí adresa – Ulice2'
-    registration_field = 'address__default__street2'
-
-
-class HomeAddress3(MojeIDAttribute):
-    code = 'h_address3'
-    schema = 'http://specs.nic.cz/attr/addr/main/street3'
-    text = _(u'Home Address – Street3')  # 'Domácí adresa – Ulice3'
-    registration_field = 'address__default__street3'
-
-
-class HomeCity(MojeIDAttribute):
-    code = 'h_city'
-    schema = 'http://axschema.org/contact/city/home'
-    text = _(u'Home Address – City')  # 'Domácí adresa – Město'
-    registration_field = 'address__default__city'
-
-
-class HomeState(MojeIDAttribute):
-    code = 'h_state'
-    schema = 'http://axschema.org/contact/state/home'
-    text = _(u'Home Address – State')  # 'Domácí adresa – Stát'
-    registration_field = 'address__default__state'
-
-
-class HomeCountry(MojeIDAttribute):
-    code = 'h_country'
-    schema = 'http://axschema.org/contact/country/home'
-    text = _(u'Home Address – Country')  # 'Domácí adresa – Země'
-    registration_field = 'address__default__country'
+    __slots__ = ()
+    kind = BOOLEAN
 
 
-class HomePostCode(MojeIDAttribute):
-    code = 'h_postcode'
-    schema = 'http://axschema.org/contact/postalCode/home'
-    text = _(u'Home Address – Country')  # 'Domácí adresa – PSČ'
-    registration_field = 'address__default__postal_code'
+class MojeIDImageAttribute(MojeIDAttribute):
+    __slots__ = ()
+    kind = IMAGE
 
 
-class BillingAddress(MojeIDAttribute):
-    code = 'b_address'
-    schema = 'http://specs.nic.cz/attr/addr/bill/street'
-    text = _(u'Billing Address – Street')  # 'Faktur. adresa – Ulice'
-    registration_field = 'address__billing__street1'
+# Base64 characters of an image decoded at once (a multiple of 4)
+IMAGE_CHUNK_SIZE = 64 * 1024
 
+# Extensions of the image files according to their first bytes
+IMAGE_SIGNATURES = (
+    ('\x89PNG', '.png'),
+    ('\xff\xd8', '.jpg'),
+    ('GIF8', '.gif'),
+)
 
-class BillingAddress2(MojeIDAttribute):
-    code = 'b_address2'
-    schema = 'http://specs.nic.cz/attr/addr/bill/street2'
-    text = _(u'Billing Address – Street2')  # 'Faktur. adresa – Ulice2'
-    registration_field = 'address__billing__street2'
+BASE64_RE = re.compile(r'^(?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?$')
 
 
-class BillingAddress3(MojeIDAttribute):
-    code = 'b_address3'
-    schema = 'http://specs.nic.cz/attr/addr/bill/street3'
-    text = _(u'Billing Address – Street3')  # 'Faktur. adresa – Ulice3'
-    registration_field = 'address__billing__street3'
+def prepare_image(data):
+    """ Name of the file of a base64 encoded image and the normalized data
 
+        The name is given by the hash of the base64 data, so the image
+        doesn't have to be decoded. Returns None when the image is invalid
+        or too large.
+    """
+    if not data:
+        return None
 
-class BillingCity(MojeIDAttribute):
-    code = 'b_city'
-    schema = 'http://specs.nic.cz/attr/addr/bill/city'
-    text = _(u'Billing Address – City')  # 'Faktur. adresa – Město'
-    registration_field = 'address__billing__city'
-
-
-class BillingState(MojeIDAttribute):
-    code = 'b_state'
-    schema = 'http://specs.nic.cz/attr/addr/bill/sp'
-    text = _(u'Billing Address – State')  # 'Faktur. adresa – Stát'
-    registration_field = 'address__billing__state'
-
-
-class BillingCountry(MojeIDAttribute):
-    code = 'b_country'
-    schema = 'http://specs.nic.cz/attr/addr/bill/cc'
-    text = _(u'Billing Address – Country')  # 'Faktur. adresa – Země'
-    registration_field = 'address__billing__country'
-
-
-class BillingPostCode(MojeIDAttribute):
-    code = 'b_postcode'
-    schema = 'http://specs.nic.cz/attr/addr/bill/pc'
-    text = _(u'Billing Address – Postal Code')  # 'Faktur. adresa – PSČ'
-    registration_field = 'address__billing__postal_code'
-
-
-class ShippingAddress(MojeIDAttribute):
-    code = 's_address'
-    schema = 'http://specs.nic.cz/attr/addr/ship/street'
-    text = _(u'Shipping Address – Street')  # 'Doruč. adresa – Ulice'
-    registration_field = 'address__shipping__street1'
-
-
-class ShippingAddress2(MojeIDAttribute):
-    code = 's_address2'
-    schema = 'http://specs.nic.cz/attr/addr/ship/street2'
-    text = _(u'Shipping Address – Street2')  # 'Doruč. adresa – Ulice2'
-    registration_field = 'address__shipping__street2'
-
-
-class ShippingAddress3(MojeIDAttribute):
-    code = 's_address3'
-    schema = 'http://specs.nic.cz/attr/addr/ship/street3'
-    text = _(u'Shipping Address – Street3')  # 'Doruč. adresa – Ulice3'
-    registration_field = 'address__shipping__street3'
-
-
-class ShippingCity(MojeIDAttribute):
-    code = 's_city'
-    schema = 'http://specs.nic.cz/attr/addr/ship/city'
-    text = _(u'Shipping Address – City')  # 'Doruč. adresa – Město'
-    registration_field = 'address__shipping__city'
-
-
-class ShippingState(MojeIDAttribute):
-    code = 's_state'
-    schema = 'http://specs.nic.cz/attr/addr/ship/sp'
-    text = _(u'Shipping Address – State')  # 'Doruč. adresa – Stát'
-    registration_field = 'address__shipping__state'
-
-
-class ShippingCountry(MojeIDAttribute):
-    code = 's_country'
-    schema = 'http://specs.nic.cz/attr/addr/ship/cc'
-    text = _(u'Shipping Address – Country')  # 'Doruč. adresa – Země'
-    registration_field = 'address__shipping__country'
-
-
-class ShippingPostCode(MojeIDAttribute):
-    code = 's_postcode'
-    schema = 'http://specs.nic.cz/attr/addr/ship/pc'
-    text = _(u'Shipping Address – Postal Code')  # 'Doruč. adresa – PSČ'
-    registration_field = 'address__shipping__postal_code'
-
-
-class MailingAddress(MojeIDAttribute):
-    code = 'm_address'
-    schema = 'http://specs.nic.cz/attr/addr/mail/street'
-    text = _(u'Mailing Address – Street')  # 'Koresp. adresa – Ulice'
-    registration_field = 'address__mailing__street1'
-
-
-class MailingAddress2(MojeIDAttribute):
-    code = 'm_address2'
-    schema = 'http://specs.nic.cz/attr/addr/mail/street2'
-    text = _(u'Mailing Address – Street2')  # 'Koresp. adresa – Ulice2'
-    registration_field = 'address__mailing__street2'
-
-
-class MailingAddress3(MojeIDAttribute):
-    code = 'm_address3'
-    schema = 'http://specs.nic.cz/attr/addr/mail/street3'
-    text = _(u'Mailing Address – Street3')  # 'Koresp. adresa – Ulice3'
-    registration_field = 'address__mailing__street3'
-
-
-class MailingCity(MojeIDAttribute):
-    code = 'm_city'
-    schema = 'http://specs.nic.cz/attr/addr/mail/city'
-    text = _(u'Mailing Address – City')  # 'Koresp. adresa – Město'
-    registration_field = 'address__mailing__city'
-
-
-class MailingState(MojeIDAttribute):
-    code = 'm_state'
-    schema = 'http://specs.nic.cz/attr/addr/mail/sp'
-    text = _(u'Mailing Address – State')  # 'Koresp. adresa – Stát'
-    registration_field = 'address__mailing__state'
-
-
-class MailingCountry(MojeIDAttribute):
-    code = 'm_country'
-    schema = 'http://specs.nic.cz/attr/addr/mail/cc'
-    text = _(u'Mailing Address – Country')  # 'Koresp. adresa – Země'
-    registration_field = 'address__mailing__country'
-
-
-class MailingPostCode(MojeIDAttribute):
-    code = 'm_postcode'
-    schema = 'http://specs.nic.cz/attr/addr/mail/pc'
-    text = _(u'Mailing Address – Postal Code')  # 'Koresp. adresa – PSČ'
-    registration_field = 'address__mailing__postal_code'
-
-
-class Phone(MojeIDAttribute):
-    code = 'phone'
-    schema = 'http://axschema.org/contact/phone/default'
-    text = _(u'Phone – Default')  # 'Telefon – Hlavní'
-    registration_field = 'phone__default__number'
-
-
-class PhoneHome(MojeIDAttribute):
-    code = 'phone_home'
-    schema = 'http://axschema.org/contact/phone/home'
-    text = _(u'Phone – Home')  # 'Telefon – Domácí'
-    registration_field = 'phone__home__number'
-
-
-class PhoneWork(MojeIDAttribute):
-    code = 'phone_work'
-    schema = 'http://axschema.org/contact/phone/business'
-    text = _(u'Phone – Work')  # 'Telefon – Pracovní'
-    registration_field = 'phone__office__number'
-
-
-class PhoneMobile(MojeIDAttribute):
-    code = 'phone_mobile'
-    schema = 'http://axschema.org/contact/phone/cell'
-    text = _(u'Phone – Mobile')  # 'Telefon – Mobil'
-    registration_field = 'phone__mobile__number'
-
-
-class Fax(MojeIDAttribute):
-    code = 'fax'
-    schema = 'http://axschema.org/contact/phone/fax'
-    text = _(u'Fax')  # 'Telefon – Fax'
-
-
-class Email(MojeIDAttribute):
-    code = 'email'
-    schema = 'http://axschema.org/contact/email'
-    text = _(u'Email – Default')  # 'Email – Hlavní'
-    registration_field = 'email__default__email'
-
-
-class Email2(MojeIDAttribute):
-    code = 'email2'
-    schema = 'http://specs.nic.cz/attr/email/notify'
-    text = _(u'Email – Notify')  # 'Email – Notifikační'
-    registration_field = 'email__notify__email'
-
-
-class Email3(MojeIDAttribute):
-    code = 'email3'
-    schema = 'http://specs.nic.cz/attr/email/next'
-    text = _(u'Email – Other')  # 'Email – Další'
-    registration_field = 'email__next__email'
-
-
-class Url(MojeIDAttribute):
-    code = 'url'
-    schema = 'http://axschema.org/contact/web/default'
-    text = _(u'URL – Default')  # 'URL – Hlavní'
-    registration_field = 'urladdress__main__url'
-
-
-class Blog(MojeIDAttribute):
-    code = 'blog'
-    schema = 'http://axschema.org/contact/web/blog'
-    text = _(u'URL – Blog')  # 'URL – Blog'
-    registration_field = 'urladdress__blog__url'
-
-
-class Url2(MojeIDAttribute):
-    code = 'url2'
-    schema = 'http://specs.nic.cz/attr/url/personal'
-    text = _(u'URL – Personal')  # 'URL – Osobní'
-    registration_field = 'urladdress__personal__url'
-
-
-class Url3(MojeIDAttribute):
-    code = 'url3'
-    schema = 'http://specs.nic.cz/attr/url/work'
-    text = _(u'URL – Work')  # 'URL – Pracovní'
-    registration_field = 'urladdress__office__url'
-
-
-class RSS(MojeIDAttribute):
-    code = 'rss'
-    schema = 'http://specs.nic.cz/attr/url/rss'
-    text = _(u'URL – RSS')  # 'URL – RSS'
-    registration_field = 'urladdress__rss__url'
-
-
-class Facebook(MojeIDAttribute):
-    code = 'fb'
-    schema = 'http://specs.nic.cz/attr/url/facebook'
-    text = _(u'URL – Facebook')  # 'URL – Facebook'
-    registration_field = 'urladdress__facebook__url'
-
-
-class Twitter(MojeIDAttribute):
-    code = 'twitter'
-    schema = 'http://specs.nic.cz/attr/url/twitter'
-    text = _(u'URL – Twitter')  # 'URL – Twitter'
-    registration_field = 'urladdress__twitter__url'
-
-
-class LinkedIn(MojeIDAttribute):
-    code = 'linkedin'
-    schema = 'http://specs.nic.cz/attr/url/linkedin'
-    text = _(u'URL – LinkedIN')  # 'URL – LinkedIN'
-    registration_field = 'urladdress__linkedin__url'
-
-
-class ICQ(MojeIDAttribute):
-    code = 'icq'
-    schema = 'http://axschema.org/contact/IM/ICQ'
-    text = _(u'IM – ICQ')  # 'IM – ICQ'
-    registration_field = 'imaccount__icq__username'
-
-
-class Jabber(MojeIDAttribute):
-    code = 'jabber'
-    schema = 'http://axschema.org/contact/IM/Jabber'
-    text = _(u'IM – Jabber')  # 'IM – Jabber'
-    registration_field = 'imaccount__jabber__username'
-
-
-class Skype(MojeIDAttribute):
-    code = 'skype'
-    schema = 'http://axschema.org/contact/IM/Skype'
-    text = _(u'IM – Skype')  # 'IM – Skype'
-    registration_field = 'imaccount__skype__username'
-
-
-class GoogleTalk(MojeIDAttribute):
-    code = 'gtalk'
-    schema = 'http://specs.nic.cz/attr/im/google_talk'
-    text = _(u'IM – Google Talk')  # 'IM – Google Talk'
-    registration_field = 'imaccount__google_talk__username'
-
-
-class WindowsLive(MojeIDAttribute):
-    code = 'wlive'
-    schema = 'http://specs.nic.cz/attr/im/windows_live'
-    text = _(u'IM – Windows Live')  # 'IM – Windows Live'
-    registration_field = 'imaccout__windows_live__username'
-
-
-class ICO(MojeIDAttribute):
-    code = 'vat_id'
-    schema = 'http://specs.nic.cz/attr/contact/ident/vat_id'
-    text = _(u'Identifier – VAT Identification Number')  # 'Identifikátor – ICO'
-    registration_field = 'vat_id_num'
+    try:
+        data = data.encode('ascii').translate(None, ' \t\r\n')
+    except UnicodeError:
+        return None
 
+    # Too large images are ignored without decoding
+    max_size = getattr(settings, 'MOJEID_IMAGE_MAX_SIZE', 1024 * 1024)
+    if not data or len(data) > (max_size + 2) // 3 * 4 or not BASE64_RE.match(data):
+        return None
 
-class DIC(MojeIDAttribute):
-    code = 'vat'
-    schema = 'http://specs.nic.cz/attr/contact/vat'
-    text = _(u'Identifier – VAT registration Number')  # 'Identifikátor – DIC'
-    registration_field = 'vat_reg_num'
+    # Only the first bytes are decoded to guess the type
+    head = binascii.a2b_base64(data[:12])
+    extension = ''
+    for signature, signature_extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            extension = signature_extension
+            break
 
+    name = '%s%s%s' % (getattr(settings, 'MOJEID_IMAGE_UPLOAD_TO', 'mojeid/'),
+                       hashlib.sha1(data).hexdigest(), extension)
+    return name, data
 
-class IdentityCard(MojeIDAttribute):
-    code = 'op'
-    schema = 'http://specs.nic.cz/attr/contact/ident/card'
-    text = _(u'Identifier – ID Card')  # 'Identifikátor – OP'
-    registration_field = 'id_card_num'
 
+def save_image(name, data):
+    """ Decode a prepared image to the file storage unless it is there already """
+    storage_class = getattr(settings, 'MOJEID_IMAGE_STORAGE', None)
+    storage = get_storage_class(storage_class)() if storage_class else default_storage
+    if storage.exists(name):
+        return name
 
-class Passport(MojeIDAttribute):
-    code = 'pas'
-    schema = 'http://specs.nic.cz/attr/contact/ident/pass'
-    text = _(u'Identifier – Passport')  # 'Identifikátor – PAS'
-    registration_field = 'passport_num'
+    with tempfile.TemporaryFile() as image:
+        for start in xrange(0, len(data), IMAGE_CHUNK_SIZE):
+            image.write(binascii.a2b_base64(data[start:start + IMAGE_CHUNK_SIZE]))
+        image.seek(0)
+        return storage.save(name, File(image))
 
 
-class MPSV(MojeIDAttribute):
-    code = 'mpsv'
-    schema = 'http://specs.nic.cz/attr/contact/ident/ssn'
-    text = _(u'Identifier – MPSV')  # 'Identifikátor – MPSV'
-    registration_field = 'ssn_id_num'
+def store_image(data):
+    """ Store a base64 encoded image in the file storage
 
+        Returns the name of the file or None when the image is invalid or too large.
+    """
+    prepared = prepare_image(data)
+    if prepared is None:
+        return None
+    return save_image(*prepared)
 
-class Student(MojeIDBooleanAttribute):
-    code = 'student'
-    schema = 'http://specs.nic.cz/attr/contact/student'
-    text = _(u'Flag – Student')  # 'Příznak – Student'
 
+class AttributeFactory(object):
+    """ Creates the attributes of a kind, e.g. Email('auth', 'User', 'email', 'pk') """
 
-class Validated(MojeIDBooleanAttribute):
-    # Probably not supported anymore
-    code = 'validated'
-    schema = 'http://specs.nic.cz/attr/contact/valid'
-    text = _(u'Flag – Validation')  # 'Příznak – Validace'
+    __slots__ = ('spec', )
 
+    def __init__(self, spec):
+        self.spec = spec
 
-class Status(MojeIDAttribute):
-    # Probably not supported anymore
-    code = 'status'
-    schema = 'http://specs.nic.cz/attr/contact/status'
-    text = _(u'Account State')  # 'Stav účtu'
+    def __call__(self, *args, **kwargs):
+        kwargs['spec'] = self.spec
+        return MojeIDAttribute(*args, **kwargs)
 
+    def __getattr__(self, name):
+        # Email.code, Email.schema, ...
+        return getattr(self.spec, name)
 
-class Adult(MojeIDBooleanAttribute):
-    code = 'adult'
-    schema = 'http://specs.nic.cz/attr/contact/adult'
-    text = _(u'Flag – Adult')  # 'Příznak – Starší 18 let'
 
+CATALOG_BY_CODE = {}
+CATALOG_BY_SCHEMA = {}
 
-class Image(MojeIDAttribute):
-    code = 'image'
-    schema = 'http://specs.nic.cz/attr/contact/image'
-    text = _(u'Image (base64)')  # 'Obrázek (base64)'
+# The attributes of the catalog in declare.py are available as module
+# members, e.g. mojeid.Email
+for _name, _code, _schema, _text, _registration_field, _kind in CATALOG:
+    _factory = AttributeFactory(AttributeSpec(_code, _schema, _text, _registration_field, _kind))
+    CATALOG_BY_CODE[_code] = CATALOG_BY_SCHEMA[_schema] = globals()[_name] = _factory
+del _name, _code, _schema, _text, _registration_field, _kind, _factory
 
 
 class Assertion:
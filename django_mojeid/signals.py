@@ -41,6 +41,10 @@ authenticate_user = Signal(providing_args=['request', 'openid_response', 'redire
 
 associate_user = Signal(providing_args=['request', 'openid_response', 'redirect'])
 
+# Sent after every call of an attribute handler during the login,
+# outcome is 'success', 'error' or 'timeout'
+handler_finished = Signal(providing_args=['handler_name', 'duration', 'outcome'])
+
 # Fetch the delete user
 user_model = get_user_model()
 
@@ -48,9 +52,14 @@ user_model = get_user_model()
 @receiver(post_delete, sender=user_model, dispatch_uid='user_delete')
 def delete_association(**kwargs):
 
-    from django_mojeid.models import UserOpenID
+    from django_mojeid.models import (
+        HandlerCall, MojeIDProfile, UserAttributeSync, UserOpenID)
 
     sender = kwargs['sender']
     user = kwargs['instance']
     if sender == user_model:
         UserOpenID.objects.filter(user_id=user.pk).delete()
+        # A new user might get the same id
+        UserAttributeSync.objects.filter(user_id=user.pk).delete()
+        MojeIDProfile.objects.filter(user_id=user.pk).delete()
+        HandlerCall.objects.filter(user_id=user.pk).delete()
@@ -28,20 +28,80 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import base64
+import threading
 import time
 
+from functools import wraps
+
+from django.conf import settings
+
 from openid.association import Association as OIDAssociation
 from openid.store.interface import OpenIDStore
 from openid.store.nonce import SKEW
 
+from django_mojeid.breaker import CircuitBreaker
 from django_mojeid.models import Association, Nonce
 
+# Verification modes
+SMART_MODE = 'smart'
+STATELESS_MODE = 'stateless'
+
+_store_breaker = None
+_store_breaker_lock = threading.Lock()
+
+
+def get_store_breaker():
+    """ Return the circuit breaker which watches the store operations """
+    global _store_breaker
+    if _store_breaker is None:
+        with _store_breaker_lock:
+            if _store_breaker is None:
+                _store_breaker = CircuitBreaker(
+                    failure_threshold=getattr(settings, 'OPENID_STORE_FAILURE_THRESHOLD', 3),
+                    latency_threshold=getattr(settings, 'OPENID_STORE_LATENCY_THRESHOLD', 1.0),
+                    reset_timeout=getattr(settings, 'OPENID_STORE_RETRY_INTERVAL', 30),
+                )
+    return _store_breaker
+
+
+def get_store_mode():
+    """ Return the verification mode which is currently used by the consumers """
+    if get_store_breaker().is_open():
+        return STATELESS_MODE
+    return SMART_MODE
+
+
+def use_store():
+    """ Decide whether a new consumer should use the store """
+    if not getattr(settings, 'OPENID_STATELESS_FAILOVER', True):
+        return True
+    return get_store_breaker().allow()
+
+
+def monitored(f):
+    """ Report the errors and the duration of the store operation """
+
+    @wraps(f)
+    def wrapped_function(*args, **kwargs):
+        breaker = get_store_breaker()
+        start = time.time()
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success(time.time() - start)
+        return result
+
+    return wrapped_function
+
 
 class DjangoOpenIDStore(OpenIDStore):
 
     def __init__(self):
         self.max_nonce_age = 6 * 60 * 60  # Six hours
 
+    @monitored
     def storeAssociation(self, server_url, association):
         try:
             assoc = Association.objects.get(
@@ -61,6 +121,7 @@ class DjangoOpenIDStore(OpenIDStore):
             assoc.assoc_type = association.assoc_type
         assoc.save()
 
+    @monitored
     def getAssociation(self, server_url, handle=None):
         assocs = []
         if handle is not None:
@@ -86,6 +147,7 @@ class DjangoOpenIDStore(OpenIDStore):
         associations.sort()
         return associations[-1][1]
 
+    @monitored
     def removeAssociation(self, server_url, handle):
         assocs = list(Association.objects.filter(
             server_url=server_url, handle=handle))
@@ -94,6 +156,7 @@ class DjangoOpenIDStore(OpenIDStore):
             assoc.delete()
         return assocs_exist
 
+    @monitored
     def useNonce(self, server_url, timestamp, salt):
         if abs(timestamp - time.time()) > SKEW:
             return False
@@ -30,6 +30,7 @@
 
 import urllib
 
+from contextlib import contextmanager
 from urlparse import urlsplit
 
 from django.conf import settings
@@ -44,22 +45,27 @@ try:
     from django.views.decorators.csrf import csrf_exempt
 except ImportError:
     from django.contrib.csrf.middleware import csrf_exempt
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # django < 1.6
+    from django.db.transaction import commit_on_success as atomic
 from django.utils.translation import get_language, activate as activate_lang
 
 from openid.consumer.consumer import (
-    Consumer, SUCCESS, CANCEL, FAILURE)
+    Consumer, SUCCESS, CANCEL, FAILURE, SETUP_NEEDED)
 from openid.consumer.discover import DiscoveryFailure
-from openid.extensions import ax, pape
 from openid.kvform import dictToKV
 from openid.yadis.constants import YADIS_CONTENT_TYPE
 
+from django_mojeid.attribute_handlers import defer_handlers
+from django_mojeid.consumer import SecureSessionConsumer
 from django_mojeid.forms import OpenIDLoginForm
 from django_mojeid.models import UserOpenID
 from django_mojeid.mojeid import (
     MOJEID_REGISTRATION_URL,
     MOJEID_ENDPOINT_URL,
-    get_attributes,
-    get_attribute_query,
+    get_attribute_set,
 )
 from django_mojeid.signals import (
     user_login_report,
@@ -67,10 +73,12 @@ from django_mojeid.signals import (
     authenticate_user,
     associate_user
 )
-from django_mojeid.store import DjangoOpenIDStore
+from django_mojeid.store import DjangoOpenIDStore, use_store
+from django_mojeid.breaker import find_breaker
 from django_mojeid.exceptions import (
     DjangoOpenIDException,
     IdentityAlreadyClaimed,
+    ProviderUnavailable,
 )
 from django.contrib.auth import get_user_model
 
@@ -80,6 +88,12 @@ from auth import OpenIDBackend
 from models import Nonce
 from mojeid import Assertion
 
+# Cookie which marks the browsers of the returning users
+IMMEDIATE_COOKIE = 'openid_returning'
+
+# Signed cookie with the claimed id of the last user logged in from the browser
+IDENTITY_COOKIE = 'openid_identity'
+
 
 def sanitise_redirect_url(redirect_to):
     """Sanitise the redirection URL."""
@@ -110,11 +124,19 @@ def make_consumer(request):
     """Create an OpenID Consumer object for the given Django request."""
     # Give the OpenID library its own space in the session object.
     session = request.session.setdefault('OPENID', {})
-    store = DjangoOpenIDStore()
-    return Consumer(session, store)
+    # Use the stateless mode while the store is failing
+    store = DjangoOpenIDStore() if use_store() else None
+    consumer = Consumer(session, store, consumer_class=SecureSessionConsumer)
+
+    # e.g. [('HMAC-SHA256', 'no-encryption')]
+    association_types = getattr(settings, 'OPENID_ASSOCIATION_TYPES', None)
+    if association_types:
+        consumer.setAssociationPreference(association_types)
 
+    return consumer
 
-def render_openid_request(request, openid_request, return_to):
+
+def render_openid_request(request, openid_request, return_to, immediate=False):
     """ Render an OpenID authentication request.
         This request will automatically redirect client to OpenID server.
     """
@@ -125,16 +147,50 @@ def render_openid_request(request, openid_request, return_to):
 
     # Directly redirect to the OpenID server
     if openid_request.shouldSendRedirect():
-        redirect_url = openid_request.redirectURL(realm, return_to)
+        redirect_url = openid_request.redirectURL(realm, return_to, immediate)
         return HttpResponseRedirect(redirect_url)
 
     # Render a form wich will redirect the client
     else:
-        form_html = openid_request.htmlMarkup(realm, return_to,
+        form_html = openid_request.htmlMarkup(realm, return_to, immediate,
                                               form_tag_attrs={'id': 'openid_message'})
         return HttpResponse(form_html, content_type='text/html;charset=UTF-8')
 
 
+def is_returning_user(request):
+    """ Whether the identity which is going to log in is already known """
+    if not getattr(settings, 'OPENID_INCREMENTAL_ATTRIBUTES', False):
+        return False
+
+    user = OpenIDBackend.get_user_from_request(request)
+    if user:
+        return OpenIDBackend.is_user_associated_with_openid(user)
+
+    claimed_id = request.get_signed_cookie(IDENTITY_COOKIE, None, salt=IDENTITY_COOKIE)
+    return bool(claimed_id) and UserOpenID.objects.filter(claimed_id=claimed_id).exists()
+
+
+def get_stored_openid_url(request):
+    """ The url used to begin the current login """
+    return request.session.get('OPENID', {}).get(
+        'openid_url', getattr(settings, 'MOJEID_ENDPOINT_URL', MOJEID_ENDPOINT_URL))
+
+
+@contextmanager
+def login_transaction():
+    """ Run the login in a single transaction if enabled
+
+        The attribute handlers are called after the transaction is committed.
+    """
+    if not getattr(settings, 'OPENID_ATOMIC_LOGIN', False):
+        yield
+        return
+
+    with defer_handlers():
+        with atomic():
+            yield
+
+
 def render_failure(request, error, template_name='openid/failure.html'):
     """Render an error page to the user."""
     # Render the response to trigger_error signal
@@ -199,13 +255,45 @@ def login_begin(request, attribute_set='default', form_class=OpenIDLoginForm):
     if login_form.is_valid():
         openid_url = login_form.cleaned_data['openid_identifier']
 
+    # Don't wait for the provider which is known to be failing
+    breaker = find_breaker(openid_url)
+    if breaker and breaker.is_open():
+        return render_failure(request, errors.DiscoveryError(ProviderUnavailable()))
+
+    # Try to log in a returning user without any interaction
+    immediate = getattr(settings, 'OPENID_IMMEDIATE_MODE', False) and \
+        IMMEDIATE_COOKIE in request.COOKIES
+
+    lang = request.POST.get('lang', get_language())
+
+    # Don't ask for the attributes which won't be used for an existing user
+    incremental = is_returning_user(request)
+
+    return begin_openid_request(request, openid_url, attribute_set, lang,
+                                redirect_to, immediate, incremental)
+
+
+def begin_openid_request(request, openid_url, attribute_set, lang, redirect_to,
+                         immediate=False, incremental=False):
+    """Perform the discovery and render the OpenID authentication request.
+
+    When incremental is set only the updatable attributes and the attributes
+    of the handlers are requested.
+    """
+
     consumer = make_consumer(request)
 
     # Set response handler (define the settings set)
     consumer.session['attribute_set'] = attribute_set
 
     # Set the language
-    consumer.session['stored_lang'] = request.POST.get('lang', get_language())
+    consumer.session['stored_lang'] = lang
+
+    # Store the url to be able to restart the login interactively
+    consumer.session['openid_url'] = openid_url
+
+    # Remember that the response won't contain the full set
+    consumer.session['incremental'] = incremental
     request.session.save()
 
     try:
@@ -213,22 +301,11 @@ def login_begin(request, attribute_set='default', form_class=OpenIDLoginForm):
     except DiscoveryFailure, exc:
         return render_failure(request, errors.DiscoveryError(exc))
 
-    # Request user details.
-    attributes = get_attribute_query(attribute_set)
-
-    fetch_request = ax.FetchRequest()
-    for attribute, required in attributes:
-        fetch_request.add(attribute.generate_ax_attrinfo(required))
-
-    if attributes:
-        openid_request.addExtension(fetch_request)
-
-    if getattr(settings, 'OPENID_PHYSICAL_MULTIFACTOR_REQUIRED', False):
-        preferred_auth = [
-            pape.AUTH_MULTI_FACTOR_PHYSICAL,
-        ]
-        pape_request = pape.Request(preferred_auth_policies=preferred_auth)
-        openid_request.addExtension(pape_request)
+    # Request user details (AX and PAPE are prepared in advance)
+    attributes = get_attribute_set(attribute_set)
+    extensions = attributes.update_extensions if incremental else attributes.extensions
+    for extension in extensions:
+        openid_request.addExtension(extension)
 
     # Construct the request completion URL, including the page we
     # should redirect to.
@@ -244,7 +321,7 @@ def login_begin(request, attribute_set='default', form_class=OpenIDLoginForm):
         return_to += urllib.urlencode(
             {OpenIDBackend.get_redirect_field_name(): redirect_to.encode("UTF-8")})
 
-    return render_openid_request(request, openid_request, return_to)
+    return render_openid_request(request, openid_request, return_to, immediate)
 
 
 def registration(request, attribute_set='default',
@@ -267,13 +344,12 @@ def registration(request, attribute_set='default',
     nonce.save()
 
     fields = []
-    attributes = [x for x in get_attributes(attribute_set) if x.type == 'attribute']
     # Append attributes to creation request if user is valid
     if user:
-        for attribute in attributes:
-            form_attr = attribute.registration_form_attrs_html(user_id)
-            if form_attr:
-                fields.append(form_attr)
+        # The models might not be updated from the last login yet
+        if getattr(settings, 'MOJEID_PROFILE_SNAPSHOTS', False):
+            OpenIDBackend.materialize_profiles(user_id)
+        fields = get_attribute_set(attribute_set).registration_fields_html(user_id)
 
     # Render the redirection template
     return render_to_response(
@@ -308,43 +384,52 @@ def login_complete(request):
 
     if openid_response.status == SUCCESS:
 
+        restart = False
         try:
-            if user_orig:
-                # Send a signal to obtain HttpResponse
-                resp = associate_user.send(sender=__name__, request=request,
-                                           openid_response=openid_response,
-                                           attribute_set=attribute_set,
-                                           redirect=redirect_to)
-                resp = [r[1] for r in resp if isinstance(r[1], HttpResponse)]
-                if resp:
-                    # Return first valid response
-                    return resp[0]
-
-                # Create association with currently logged in user
-                OpenIDBackend.associate_openid_response(user_orig, openid_response)
-            else:
-                # Authenticate mojeID user.
-                # Send a signal to obtain HttpResponse
-                resp = authenticate_user.send(sender=__name__, request=request,
-                                              openid_response=openid_response,
-                                              attribute_set=attribute_set,
-                                              redirect=redirect_to)
-                resp = [r[1] for r in resp if isinstance(r[1], HttpResponse)]
-                if resp:
-                    # Return first valid response
-                    return resp[0]
-
-                # Perform a default action
-                user_new = OpenIDBackend.authenticate_using_all_backends(
-                    openid_response=openid_response, attribute_set=attribute_set)
-                if not user_new:
-                    # Failed to create a user
-                    return render_failure(request, errors.UnknownUser())
-                if not OpenIDBackend.is_user_active(user_new):
-                    # user is deactivated
-                    return render_failure(request, errors.DisabledAccount(user_new))
-                # Create an association with the new user
-                OpenIDBackend.associate_user_with_session(request, user_new)
+            with login_transaction():
+                if user_orig:
+                    # Send a signal to obtain HttpResponse
+                    resp = associate_user.send(sender=__name__, request=request,
+                                               openid_response=openid_response,
+                                               attribute_set=attribute_set,
+                                               redirect=redirect_to)
+                    resp = [r[1] for r in resp if isinstance(r[1], HttpResponse)]
+                    if resp:
+                        # Return first valid response
+                        return resp[0]
+
+                    # Create association with currently logged in user
+                    OpenIDBackend.associate_openid_response(user_orig, openid_response)
+                elif request.session.get('OPENID', {}).get('incremental') and \
+                        getattr(settings, 'OPENID_CREATE_USERS', False) and \
+                        not UserOpenID.objects.filter(
+                            claimed_id=openid_response.identity_url).exists():
+                    # The identity is not known, the new user needs the full set.
+                    # The discovery doesn't run in the transaction.
+                    restart = True
+                else:
+                    # Authenticate mojeID user.
+                    # Send a signal to obtain HttpResponse
+                    resp = authenticate_user.send(sender=__name__, request=request,
+                                                  openid_response=openid_response,
+                                                  attribute_set=attribute_set,
+                                                  redirect=redirect_to)
+                    resp = [r[1] for r in resp if isinstance(r[1], HttpResponse)]
+                    if resp:
+                        # Return first valid response
+                        return resp[0]
+
+                    # Perform a default action
+                    user_new = OpenIDBackend.authenticate_using_all_backends(
+                        openid_response=openid_response, attribute_set=attribute_set)
+                    if not user_new:
+                        # Failed to create a user
+                        return render_failure(request, errors.UnknownUser())
+                    if not OpenIDBackend.is_user_active(user_new):
+                        # user is deactivated
+                        return render_failure(request, errors.DisabledAccount(user_new))
+                    # Create an association with the new user
+                    OpenIDBackend.associate_user_with_session(request, user_new)
         except DjangoOpenIDException, e:
             # Something went wrong
             user_id = None
@@ -370,8 +455,25 @@ def login_complete(request):
             # Render the failure page
             return render_failure(request, errors.AuthenticationFailed(e))
 
+        if restart:
+            response = begin_openid_request(request, get_stored_openid_url(request),
+                                            attribute_set, lang, redirect_to)
+            response.delete_cookie(IDENTITY_COOKIE)
+            return response
+
         response = HttpResponseRedirect(redirect_to)
 
+        # The next login from this browser can try the immediate mode
+        if getattr(settings, 'OPENID_IMMEDIATE_MODE', False):
+            response.set_cookie(IMMEDIATE_COOKIE, '1', max_age=365 * 24 * 60 * 60,
+                                httponly=True)
+
+        # The next login from this browser can skip the unused attributes
+        if getattr(settings, 'OPENID_INCREMENTAL_ATTRIBUTES', False):
+            response.set_signed_cookie(IDENTITY_COOKIE, openid_response.identity_url,
+                                       salt=IDENTITY_COOKIE, max_age=365 * 24 * 60 * 60,
+                                       httponly=True)
+
         # Send signal to log the successful login attempt
         user_login_report.send(sender=__name__,
                                request=request,
@@ -381,6 +483,12 @@ def login_complete(request):
 
         return response
 
+    # The immediate login is not possible, continue interactively
+    elif openid_response.status == SETUP_NEEDED:
+        incremental = request.session.get('OPENID', {}).get('incremental', False)
+        return begin_openid_request(request, get_stored_openid_url(request), attribute_set,
+                                    lang, redirect_to, incremental=incremental)
+
     # Render other failures
     elif openid_response.status == FAILURE:
         user_login_report.send(sender=__name__,
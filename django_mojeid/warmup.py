@@ -0,0 +1,70 @@
+# django-mojeid - mojeID integration for django
+#
+# Copyright (C) 2013 CZ.NIC
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Warmup of the application before the first login"""
+
+from django.conf import settings
+from django.utils import translation
+
+
+def warmup(start_dh_pool=False):
+    """ Do the work which would be otherwise done lazily by the first login
+
+        The attribute sets are built, i.e. all the models and fields are
+        resolved and validated, the openid modules are imported and the
+        translations of the attributes are loaded.
+
+        In a pre-fork server (e.g. gunicorn --preload) it should be called
+        in the master process so the workers share the result. Threads
+        don't survive the fork, so the pool of Diffie-Hellman keys should be
+        started in the workers, e.g. from the post fork hook.
+    """
+    from openid import oidutil
+
+    # Imports python-openid
+    from django_mojeid import views
+    from django_mojeid.consumer import get_dh_pool
+    from django_mojeid.mojeid import get_attribute_sets
+    from django_mojeid.store import get_store_breaker
+
+    # ElementTree is imported by python-openid during the first discovery
+    oidutil.importElementTree()
+
+    attribute_sets = get_attribute_sets()
+    get_store_breaker()
+
+    for language in getattr(settings, 'OPENID_WARMUP_LANGUAGES', [settings.LANGUAGE_CODE]):
+        with translation.override(language):
+            for attribute_set in attribute_sets.itervalues():
+                for attribute in attribute_set.model_attributes:
+                    attribute.text
+
+    pool = get_dh_pool()
+    if start_dh_pool and pool:
+        pool.start()